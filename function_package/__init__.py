@@ -1,12 +1,26 @@
 """Some functions needed for the matching"""
-from .custom_classes import Region
+from .catalogue_service import (load_catalogue_from_service,
+                                load_region_tables_warm, serve_catalogues)
+from .custom_classes import DtypePolicy, Region
 from .custom_paths import get_directory, get_filepath, get_lephare_directory
 from .file_io import read_table_from_backup, write_table_as_backup
+from .job_queue import create_job_queue, get_queue_status, run_queue_worker
+from .lephare_routines import (read_lephare_output, run_zphota,
+                               run_zphota_in_context_batches)
 from .load_and_clean_tables import (load_and_clean_opt_agn_shu,
                                     load_and_clean_sweep, load_and_clean_vhs)
-from .matching import (match_shu_with_sweep, match_vhs_to_table,
-                       match_with_galex_and_clean_it)
-from .pre_processing import (process_for_lephare, process_galex_columns,
-                             process_sweep_columns, process_vhs_columns,
-                             split_table_by_sourcetype)
+from .matching import (match_probabilistically, match_shu_with_sweep,
+                       match_vhs_to_table, match_with_galex_and_clean_it)
+from .photoz_metrics import PhotozMetrics, accumulate_photoz_metrics
+from .pipeline import (PIPELINE_STAGES, extend_region_incrementally,
+                       run_stage)
+from .pre_processing import (check_dtype_policy_precision, compute_lephare_context,
+                             prescreen_sources, process_for_lephare,
+                             process_galex_columns, process_sweep_columns,
+                             process_vhs_columns, split_table_by_sourcetype)
+from .radius_calibration import (calibrate_galex_match_radius,
+                                 calibrate_match_radius)
+from .summary_maps import (build_summary_maps, load_summary_maps,
+                           plot_histogram_2d, plot_sky_density)
 from .util import ask_file_overwrite, generate_all_filepaths
+from .zphota_cache import run_zphota_cached
@@ -0,0 +1,182 @@
+"""A local service keeping the cleaned catalogues in memory, such that region cut-outs
+can be obtained without re-reading and re-parsing the FITS files each time."""
+import io
+import json
+import logging
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from astropy.table import Table
+
+from .custom_classes import DtypePolicy, Region
+from .pipeline import load_region_tables
+
+CATALOGUE_NAMES = ("shu", "vhs", "sweep")
+DEFAULT_PORT = 8765
+
+
+def _index_by_dec(table: Table) -> Tuple[Table, np.ndarray]:
+    """Sort the table by dec, such that the sources of a dec range can be found via a
+    binary search on the returned sorted dec values."""
+    table = table[np.argsort(np.array(table["dec"]), kind="stable")]
+    return table, np.array(table["dec"])
+
+
+def _query_indexed_table(table: Table, dec_values: np.ndarray, region: Region) -> Table:
+    """Cut the region out of a table indexed via _index_by_dec."""
+    start = np.searchsorted(dec_values, region.dec_min, side="left")
+    stop = np.searchsorted(dec_values, region.dec_max, side="right")
+    return region.constrain_to_region(table[start:stop])
+
+
+def _table_to_bytes(table: Table) -> bytes:
+    """Serialise a table to the numpy binary format, appending the mask if there is one."""
+    stream = io.BytesIO()
+    array = table.as_array()
+    np.save(stream, np.ma.getdata(array), allow_pickle=False)
+    if np.ma.isMaskedArray(array):
+        np.save(stream, np.ma.getmaskarray(array), allow_pickle=False)
+    return stream.getvalue()
+
+
+def _table_from_bytes(content: bytes, units: Dict[str, str]) -> Table:
+    """Deserialise a table written by _table_to_bytes."""
+    stream = io.BytesIO(content)
+    array = np.load(stream, allow_pickle=False)
+    if stream.tell() < len(content):
+        array = np.ma.MaskedArray(array, mask=np.load(stream, allow_pickle=False))
+    table = Table(array)
+    for colname, unit in units.items():
+        table[colname].info.unit = unit
+    return table
+
+
+class _CatalogueRequestHandler(BaseHTTPRequestHandler):
+    """Answers GET requests of the form /{catalogue}?ra_min=..&ra_max=..&dec_min=..&dec_max=..
+    with the cut-out of the resident catalogue."""
+    # Set by serve_catalogues:
+    catalogues: Dict[str, Tuple[Table, np.ndarray]] = {}
+    served_region: Optional[Region] = None
+
+    def do_GET(self):
+        """Send the requested cut-out, or an error if it cannot be provided."""
+        url = urllib.parse.urlparse(self.path)
+        name = url.path.strip("/")
+        if name not in self.catalogues:
+            self.send_error(404, f"Unknown catalogue {name}")
+            return
+        try:
+            query = urllib.parse.parse_qs(url.query)
+            params = {key: float(query[key][0])
+                      for key in ["ra_min", "ra_max", "dec_min", "dec_max"]}
+            region = Region(**params)
+        except (KeyError, ValueError, AssertionError):
+            self.send_error(400, "Please provide a valid region")
+            return
+        if not self.served_region.contains(region):
+            self.send_error(416, "The requested region is not covered by the service")
+            return
+        table = _query_indexed_table(*self.catalogues[name], region)
+        content = _table_to_bytes(table)
+        units = {col: str(table[col].unit) for col in table.colnames
+                 if table[col].unit is not None}
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("X-Units", json.dumps(units))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, fmt, *args):
+        """Log the requests at debug level instead of writing them to stderr."""
+        logging.debug("Catalogue service: " + fmt, *args)
+
+
+def serve_catalogues(region: Region, port: int = DEFAULT_PORT,
+                     dtype_policy: Optional[DtypePolicy] = None):
+    """Load the cleaned shu, vhs and sweep tables for the (large) region once and serve
+    cut-outs of them on localhost until interrupted.
+    This is meant to be run in a separate, long-lived process, e. g. via
+    `python -c "import function_package as fp; fp.serve_catalogues(fp.Region(126, 146.2, -3.2, 6.2))"`.
+
+    Parameters
+    ----------
+    region : Region
+        The region to keep the catalogues for. Cut-outs can be requested for any
+        region inside of it.
+    port : int, optional
+        The localhost port to listen on, by default DEFAULT_PORT
+    dtype_policy : Optional[DtypePolicy], optional
+        The policy to convert the column dtypes with, by default None
+    """
+    tables = load_region_tables(region, dtype_policy)
+    _CatalogueRequestHandler.catalogues = {
+        name: _index_by_dec(table) for name, table in zip(CATALOGUE_NAMES, tables)}
+    _CatalogueRequestHandler.served_region = region
+    server = ThreadingHTTPServer(("127.0.0.1", port), _CatalogueRequestHandler)
+    logging.info("Serving the catalogues on port %d for the\n%s", port, region)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Shutting down the catalogue service.")
+    finally:
+        server.server_close()
+
+
+def load_catalogue_from_service(name: str, region: Region, port: int = DEFAULT_PORT) -> Table:
+    """Request the cut-out of the given catalogue from the service started via serve_catalogues.
+
+    Parameters
+    ----------
+    name : str
+        One of CATALOGUE_NAMES
+    region : Region
+        The region to cut out, which has to lie inside the region of the service
+    port : int, optional
+        The localhost port the service listens on, by default DEFAULT_PORT
+
+    Returns
+    -------
+    Table
+        The same table the corresponding `load_and_clean_*` function would return,
+        but with the rows sorted by dec
+    """
+    assert name in CATALOGUE_NAMES, f"Please request one of the following catalogues: {', '.join(CATALOGUE_NAMES)}"
+    query = urllib.parse.urlencode(region.get_param_dict())
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/{name}?{query}") as response:
+        units = json.loads(response.headers["X-Units"])
+        table = _table_from_bytes(response.read(), units)
+    logging.info("Received %d sources of the %s table from the catalogue service.",
+                 len(table), name)
+    return table
+
+
+def load_region_tables_warm(region: Region, port: int = DEFAULT_PORT,
+                            dtype_policy: Optional[DtypePolicy] = None) -> Tuple[Table, Table, Table]:
+    """Obtain the shu, vhs and sweep tables for the region from the catalogue service,
+    falling back to loading them from disk if the service is not available.
+
+    Parameters
+    ----------
+    region : Region
+        The region to constrain the tables to
+    port : int, optional
+        The localhost port the service listens on, by default DEFAULT_PORT
+    dtype_policy : Optional[DtypePolicy], optional
+        The policy to convert the column dtypes with when loading from disk, by default None
+
+    Returns
+    -------
+    tuple[Table, Table, Table]
+        The shu, vhs and sweep tables
+    """
+    try:
+        return tuple(load_catalogue_from_service(name, region, port) for name in CATALOGUE_NAMES)
+    except urllib.error.URLError as error:
+        logging.warning("Could not use the catalogue service (%s), loading the tables from disk.",
+                        error)
+        return load_region_tables(region, dtype_policy)
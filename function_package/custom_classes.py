@@ -1,10 +1,12 @@
 """Some custom classes that might be necessary"""
 import json
 from math import ceil, floor
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-from astropy.table import Table
+import numpy as np
+from astropy.table import Column, MaskedColumn, Table
 
+from .custom_constants import ALL_VHS_BANDS, SWEEP_TYPE_CODES
 from .custom_paths import get_filepath
 from .custom_types import Brickstring, Regionstring
 
@@ -105,12 +107,172 @@ class Region:
                 brick_strings.append(f"{reg_min}-{reg_max}")
         return brick_strings
 
+    def get_param_dict(self) -> Dict[str, float]:
+        """Returns the boundaries of this region as a dictionary that can be used
+        to reconstruct it via Region(**param_dict)."""
+        return {"ra_min": self.ra_min,
+                "ra_max": self.ra_max,
+                "dec_min": self.dec_min,
+                "dec_max": self.dec_max}
+
+    def split_into_tiles(self, ra_step: float, dec_step: float) -> List["Region"]:
+        """Tile this region into smaller rectangular regions.
+        The tiles at the upper edges are truncated to stay within this region.
+
+        Parameters
+        ----------
+        ra_step : float
+            The maximum extent of each tile in ra in deg
+        dec_step : float
+            The maximum extent of each tile in dec in deg
+
+        Returns
+        -------
+        list[Region]
+            The tiles, each with a stem of the form `{stem}_tile{number}`.
+        """
+        assert ra_step > 0 and dec_step > 0, "The tile sizes need to be positive."
+        # Rounding first avoids an additional degenerate tile due to floating point noise:
+        num_ra = ceil(round(self.ra_dist / ra_step, 9))
+        num_dec = ceil(round(self.dec_dist / dec_step, 9))
+        tiles = []
+        for i in range(num_ra):
+            ra_min = self.ra_min + i * ra_step
+            ra_max = min(ra_min + ra_step, self.ra_max)
+            for j in range(num_dec):
+                dec_min = self.dec_min + j * dec_step
+                dec_max = min(dec_min + dec_step, self.dec_max)
+                stem = f"{self.stem}_tile{len(tiles):03}"
+                tiles.append(Region(ra_min, ra_max, dec_min, dec_max, stem=stem))
+        return tiles
+
+    def contains(self, other: "Region") -> bool:
+        """Check whether the other region lies completely inside of this one."""
+        return (self.ra_min <= other.ra_min and other.ra_max <= self.ra_max
+                and self.dec_min <= other.dec_min and other.dec_max <= self.dec_max)
+
+    def get_padded(self, margin: float) -> "Region":
+        """Returns a copy of this region that is enlarged by the margin (in deg) on all sides."""
+        return Region(self.ra_min - margin, self.ra_max + margin,
+                      self.dec_min - margin, self.dec_max + margin, stem=self.stem)
+
+    def subtract(self, other: "Region") -> List["Region"]:
+        """Compute the part of this region that is not covered by the other one.
+
+        Parameters
+        ----------
+        other : Region
+            The region to remove from this one
+
+        Returns
+        -------
+        list[Region]
+            Up to four non-overlapping rectangular regions covering the difference,
+            each with a stem of the form `{stem}_delta{number}`.
+            The list is empty if the other region contains this one.
+        """
+        inner_ra_min = min(max(self.ra_min, other.ra_min), self.ra_max)
+        inner_ra_max = max(min(self.ra_max, other.ra_max), inner_ra_min)
+        inner_dec_min = min(max(self.dec_min, other.dec_min), self.dec_max)
+        inner_dec_max = max(min(self.dec_max, other.dec_max), inner_dec_min)
+        if inner_ra_min == inner_ra_max or inner_dec_min == inner_dec_max:
+            # There is no overlap, so the whole region remains
+            inner_ra_min = inner_ra_max = self.ra_max
+        # Strips on the left and right covering the full dec range, then the parts
+        # below and above the other region:
+        candidates = [(self.ra_min, inner_ra_min, self.dec_min, self.dec_max),
+                      (inner_ra_max, self.ra_max, self.dec_min, self.dec_max),
+                      (inner_ra_min, inner_ra_max, self.dec_min, inner_dec_min),
+                      (inner_ra_min, inner_ra_max, inner_dec_max, self.dec_max)]
+        deltas = []
+        for ra_min, ra_max, dec_min, dec_max in candidates:
+            if ra_max > ra_min and dec_max > dec_min:
+                stem = f"{self.stem}_delta{len(deltas)}"
+                deltas.append(Region(ra_min, ra_max, dec_min, dec_max, stem=stem))
+        return deltas
+
     def save_to_disk(self):
         """Saves this region to disk"""
-        param_dict = {"ra_min": self.ra_min,
-                      "ra_max": self.ra_max,
-                      "dec_min": self.dec_min,
-                      "dec_max": self.dec_max}
+        param_dict = self.get_param_dict()
         fpath = get_filepath("region_backup", stem=self.stem)
         with open(fpath, "w", encoding="utf-8") as f:
             f.write(json.dumps(param_dict))
+
+
+class DtypePolicy:
+    """A policy on the dtypes the pipeline tables are kept in to reduce their memory footprint.
+    It can be applied to the tables at load and after each stage.
+    """
+
+    def __init__(self, float_dtype: type = np.float32, encode_sweep_type: bool = True,
+                 fill_masked: bool = True, compact_ids: bool = True):
+        """Initialise a policy, by default converting to float32 photometry, integer
+        sweep_type codes and unmasked columns.
+
+        Parameters
+        ----------
+        float_dtype : type, optional
+            The dtype for all float columns apart from the positions and the VHS magnitudes,
+            by default np.float32
+        encode_sweep_type : bool, optional
+            Whether to replace the sweep_type strings by the SWEEP_TYPE_CODES, by default True
+        fill_masked : bool, optional
+            Whether to replace masked float columns by plain ones with NaN as a sentinel.
+            These end up as -99 in the LePhare input anyways, by default True
+        compact_ids : bool, optional
+            Whether to store the sweep_id strings as bytes instead of unicode, by default True
+        """
+        self.float_dtype = float_dtype
+        self.encode_sweep_type = encode_sweep_type
+        self.fill_masked = fill_masked
+        self.compact_ids = compact_ids
+
+    def _is_position_column(self, colname: str) -> bool:
+        """The ra and dec columns are always kept at float64 as float32 only provides a
+        precision of about 30 mas at the relevant coordinates."""
+        return colname in ["ra", "dec"] or colname.startswith(("ra_", "dec_"))
+
+    def _is_vhs_magnitude_column(self, colname: str) -> bool:
+        """The VHS magnitudes and extinctions are always kept at float64, as they are converted
+        to fluxes via 10**(-(mag + 48.6) / 2.5), where the float32 spacing of about 7.6e-6 at
+        mag + 48.6 ~ 68.6 would translate into relative flux deviations of the same order."""
+        return any(colname in [f"a{band}", f"mag_{band}", f"mag_{band}err",
+                               f"c_mag_{band}", f"c_mag_err_{band}"]
+                   or colname.startswith(f"{band}apermag") for band in ALL_VHS_BANDS)
+
+    def _convert_float_column(self, col: Column) -> Column:
+        """Fill and cast a single float column according to this policy."""
+        keep_float64 = self._is_position_column(col.name) or self._is_vhs_magnitude_column(col.name)
+        dtype = np.float64 if keep_float64 else self.float_dtype
+        if self.fill_masked and isinstance(col, MaskedColumn):
+            return Column(col.filled(np.nan), name=col.name, dtype=dtype,
+                          unit=col.unit, description=col.description)
+        return col.astype(dtype, copy=False)
+
+    def apply(self, table: Table) -> Table:
+        """Apply this policy to the given table.
+
+        Parameters
+        ----------
+        table : Table
+            The table to convert, which is modified in place
+
+        Returns
+        -------
+        Table
+            The converted table
+        """
+        for colname in table.colnames:
+            col = table[colname]
+            if isinstance(col, Column) and col.dtype.kind == "f":
+                table.replace_column(colname, self._convert_float_column(col))
+        if self.encode_sweep_type and "sweep_type" in table.colnames \
+                and table["sweep_type"].dtype.kind in "US":
+            codes = np.full(len(table), -1, dtype=np.int8)
+            for sweep_type, code in SWEEP_TYPE_CODES.items():
+                codes[table["sweep_type"] == sweep_type] = code
+            table.replace_column("sweep_type", Column(codes, name="sweep_type"))
+        if self.compact_ids and "sweep_id" in table.colnames \
+                and table["sweep_id"].dtype.kind == "U":
+            table.replace_column("sweep_id", table["sweep_id"].astype("S"))
+        return table
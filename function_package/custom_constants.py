@@ -6,7 +6,36 @@ ALL_VHS_BANDS = ('y', 'j', 'h', 'ks')
 
 ALL_BANDS = ALL_GALEX_BANDS + ALL_SWEEP_BANDS + ALL_VHS_BANDS
 
+# The order of the FILTER_LIST in base_in.para, which determines the bits of the LePhare
+# context (FUV=1, NUV=2, g=4, ..., W4=8192) if the input columns follow the same order:
+LEPHARE_BANDS = ('fuv', 'nuv', 'g', 'r', 'i', 'z', 'y', 'j', 'h', 'ks', 'w1', 'w2', 'w3', 'w4')
+
 # The magnitude corrections to convert from the vega to the AB system,
 # which is important for the VHS bands:
 
 VEGA_AB_DICT = {"y": 0.60, "j": 0.92, "h": 1.37, "ks": 1.83}
+
+# The integer codes used for the morphological sweep types by the memory-lean DtypePolicy.
+# Unknown types are encoded as -1.
+SWEEP_TYPE_CODES = {"PSF": 0, "REX": 1, "DEV": 2, "EXP": 3, "SER": 4, "DUP": 5}
+
+# The relative tolerance allowed between the float32 and float64 processing paths.
+# Each float32 operation contributes a relative rounding error of up to 6e-8 (half the
+# float32 epsilon of 1.2e-7), and the flux corrections chain only a handful of them, giving
+# deviations of a few 1e-7 in practice. 1e-5 leaves a margin of more than an order of
+# magnitude on top of that. Conversions amplifying the float32 rounding, like the
+# 10**(-(mag + 48.6) / 2.5) of the VHS magnitudes (about 8e-6), are kept at float64 instead.
+DTYPE_POLICY_RTOL = 1e-5
+
+# The integer codes of the routes assigned by the colour pre-screening: Sources are either
+# fitted with the full galaxy/QSO and star libraries, only with the star library, or rejected.
+PRESCREEN_ROUTE_CODES = {"full": 0, "star_only": 1, "reject": 2}
+
+# An approximate main-sequence stellar locus in the AB colours g-r, r-z, z-W1 and W1-W2,
+# sampled along g-r. The WISE colours separate the stars from QSOs of similar optical colour.
+STELLAR_LOCUS = {
+    ("g", "r"): (0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.4, 1.6),
+    ("r", "z"): (0.02, 0.14, 0.26, 0.40, 0.56, 0.78, 1.10, 1.60),
+    ("z", "w1"): (-1.65, -1.55, -1.45, -1.33, -1.20, -1.05, -0.90, -0.75),
+    ("w1", "w2"): (-0.70, -0.70, -0.69, -0.67, -0.64, -0.60, -0.55, -0.50),
+}
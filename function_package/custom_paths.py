@@ -65,8 +65,10 @@ def get_directory(dir_type: Literal["data", "catalogues", "regions",
 
 
 def get_filepath(path_type: Literal["region_backup", "match_backup", "processed_backup",
+                                    "shu_backup", "vhs_backup", "sweep_backup",
                                     "lephare_in", "lephare_out", "para_in", "para_out",
-                                    "filter", "template"],
+                                    "filter", "template", "job_queue", "zphota_cache",
+                                    "summary_maps"],
                  ttype: Optional[TableType] = None, stem="base") -> Filepath:
     """Get the unified filepath string for a given filepath type.
     Via the stem argument, the filenames can be altered.
@@ -89,15 +91,22 @@ def get_filepath(path_type: Literal["region_backup", "match_backup", "processed_
     filepath_dict = {"region_backup": f"{get_directory('data')}/regions/{stem}_backup.json",
                      "match_backup": f"{get_directory('match_backups')}{stem}_full_match.fits",
                      "processed_backup": f"{get_directory('match_backups')}{stem}_processed_{ttype}.fits",
+                     "shu_backup": f"{get_directory('match_backups')}{stem}_loaded_shu.fits",
+                     "vhs_backup": f"{get_directory('match_backups')}{stem}_loaded_vhs.fits",
+                     "sweep_backup": f"{get_directory('match_backups')}{stem}_loaded_sweep.fits",
                      "lephare_in": f"{get_lephare_directory('input')}{stem}_input_{ttype}.in",
                      "lephare_out": f"{get_lephare_directory('output')}{stem}_output_{ttype}.out",
                      "para_in": f"{get_lephare_directory('parameters')}{stem}_in.para",
                      "para_out": f"{get_lephare_directory('parameters')}{stem}_out.para",
                      "filter": f"{get_lephare_directory('filters')}{stem}.filt",
-                     "template": f"{get_lephare_directory('templates')}{stem}_{ttype}.list"}
+                     "template": f"{get_lephare_directory('templates')}{stem}_{ttype}.list",
+                     "job_queue": f"{get_directory('regions')}{stem}_queue.sqlite",
+                     "zphota_cache": f"{get_lephare_directory('output')}{stem}_zphota_cache_{ttype}.sqlite",
+                     "summary_maps": f"{get_directory('match_backups')}{stem}_summary_maps_{ttype}.npz"}
     assert path_type in filepath_dict, f"The type of file you have specified does not exist, please use one of the following: {', '.join(filepath_dict)}"
     # The path_types that do not make use of ttype:
-    need_ttype = ["processed_backup", "lephare_in", "lephare_out", "template"]
+    need_ttype = ["processed_backup", "lephare_in", "lephare_out", "template", "zphota_cache",
+                  "summary_maps"]
     assert path_type not in need_ttype or ttype is not None, "Please specify a table type for this kind of path."
     fpath = filepath_dict[path_type]
 
@@ -1,8 +1,9 @@
 """Functions concerning reading and writing files"""
 import logging
 import warnings
-from typing import Optional
+from typing import Iterator, Optional, Sequence
 
+from astropy.io import fits
 from astropy.table import Table
 from astropy.units import UnitsWarning
 
@@ -62,3 +63,50 @@ def read_table_from_backup(path_type: str, ttype: Optional[TableType] = None,
         warnings.simplefilter("ignore", UnitsWarning)
         table = Table.read(fpath, format=file_format)
     return table
+
+
+def iter_table_chunks(path_type: str, ttype: Optional[TableType] = None, stem: str = "base",
+                      chunk_size: int = 100000, names: Optional[Sequence[str]] = None) -> Iterator[Table]:
+    """Iterate over the table at the corresponding path in chunks of rows, such that only
+    one chunk needs to be kept in memory at a time.
+
+    Parameters
+    ----------
+    path_type : str
+        The path_type describing the type of table and therefore the filepath
+    ttype : Optional[TableType], optional
+        In case it's needed, specify whether the table is extended or pointlike, by default None
+    stem : str, optional
+        The stem to describe the run by, by default "base"
+    chunk_size : int, optional
+        The number of rows per chunk, by default 100000
+    names : Optional[Sequence[str]], optional
+        For ascii files without a header line (e. g. the zphota output), the names of the
+        columns, by default None, meaning that the first uncommented line is the header
+
+    Yields
+    ------
+    Table
+        The consecutive chunks of the table
+    """
+    fpath = get_filepath(path_type, ttype, stem)
+    if fpath.split(".")[-1] not in ["in", "out"]:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UnitsWarning)
+            with fits.open(fpath, memmap=True) as hdu_list:
+                data = hdu_list[1].data
+                for start in range(0, len(data), chunk_size):
+                    yield Table(data[start:start + chunk_size])
+        return
+    with open(fpath, "r", encoding="utf-8") as f:
+        lines = (line for line in f if line.strip() and not line.startswith("#"))
+        if names is None:
+            names = next(lines).split()
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield Table.read(chunk, format="ascii.no_header", names=names, guess=False)
+                chunk = []
+        if chunk:
+            yield Table.read(chunk, format="ascii.no_header", names=names, guess=False)
@@ -0,0 +1,229 @@
+"""A local task queue to run the pipeline stages for many regions with several workers.
+The queue is an SQLite file, so workers on different nodes can pull from it as long as
+they share the filesystem (and the filesystem supports the SQLite file locks)."""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Optional, Sequence, Tuple
+
+from astropy.table import Table
+
+from .custom_classes import DtypePolicy, Region
+from .custom_paths import get_filepath
+from .custom_types import Filepath
+from .pipeline import PIPELINE_STAGES, run_stage
+
+_TASK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    region_stem TEXT NOT NULL,
+    region_params TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    stage_index INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    heartbeat REAL,
+    error TEXT,
+    UNIQUE (region_stem, stage)
+)
+"""
+
+# A task is claimable if it is pending, has failed less than max_attempts times or has
+# been abandoned by its worker, and if all previous stages of its region are done.
+_CLAIM_QUERY = """
+SELECT t.id, t.region_stem, t.region_params, t.stage FROM tasks t
+WHERE t.attempts < ?
+AND (t.status IN ('pending', 'failed') OR (t.status = 'running' AND t.heartbeat < ?))
+AND NOT EXISTS (SELECT 1 FROM tasks p WHERE p.region_stem = t.region_stem
+                AND p.stage_index < t.stage_index AND p.status != 'done')
+ORDER BY t.id LIMIT 1
+"""
+
+_UNFINISHED_QUERY = """
+SELECT COUNT(*) FROM tasks t
+WHERE (t.status = 'running' AND t.heartbeat >= ?)
+OR (t.status != 'done' AND t.attempts < ?
+    AND NOT EXISTS (SELECT 1 FROM tasks p WHERE p.region_stem = t.region_stem
+                    AND p.stage_index < t.stage_index AND p.status != 'done'
+                    AND p.attempts >= ?))
+"""
+
+
+def _connect(queue_path: Filepath) -> sqlite3.Connection:
+    """Connect to the queue database, waiting for locks held by other workers."""
+    connection = sqlite3.connect(queue_path, timeout=60, isolation_level=None)
+    connection.execute(_TASK_SCHEMA)
+    return connection
+
+
+def create_job_queue(regions: Sequence[Region], stem: str = "base",
+                     stages: Sequence[str] = tuple(PIPELINE_STAGES)) -> Filepath:
+    """Add tasks for each of the given stages and regions to the queue of the given stem.
+    Tasks that are already in the queue (e. g. from an interrupted campaign) are kept
+    along with their status, so calling this again resumes the campaign.
+
+    Parameters
+    ----------
+    regions : Sequence[Region]
+        The regions to run the stages for, e. g. obtained via `Region.split_into_tiles`.
+        Each of them needs a unique stem as it is used for the backups.
+    stem : str, optional
+        The stem of the queue, by default "base"
+    stages : Sequence[str], optional
+        The stages to run for each region, by default all of PIPELINE_STAGES
+
+    Returns
+    -------
+    Filepath
+        The path of the queue file
+    """
+    assert all(stage in PIPELINE_STAGES for stage in stages), f"Please only use the following stages: {', '.join(PIPELINE_STAGES)}"
+    region_stems = [region.stem for region in regions]
+    assert len(set(region_stems)) == len(region_stems), "Please provide regions with unique stems."
+    stage_indices = {stage: i for i, stage in enumerate(PIPELINE_STAGES)}
+    queue_path = get_filepath("job_queue", stem=stem)
+    connection = _connect(queue_path)
+    connection.execute("BEGIN IMMEDIATE")
+    for region in regions:
+        region.save_to_disk()
+        params = json.dumps(region.get_param_dict())
+        connection.executemany(
+            "INSERT OR IGNORE INTO tasks (region_stem, region_params, stage, stage_index) VALUES (?, ?, ?, ?)",
+            [(region.stem, params, stage, stage_indices[stage]) for stage in stages])
+    connection.execute("COMMIT")
+    connection.close()
+    logging.info("The queue at %s contains tasks for %d regions.", queue_path, len(regions))
+    return queue_path
+
+
+def _claim_next_task(connection: sqlite3.Connection, worker: str, max_attempts: int,
+                     stale_after: float) -> Optional[Tuple[int, Region, str]]:
+    """Atomically claim the next runnable task, returning its id, region and stage."""
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        row = connection.execute(
+            _CLAIM_QUERY, (max_attempts, time.time() - stale_after)).fetchone()
+        if row is None:
+            connection.execute("COMMIT")
+            return None
+        task_id, region_stem, region_params, stage = row
+        connection.execute(
+            "UPDATE tasks SET status = 'running', worker = ?, heartbeat = ?, attempts = attempts + 1 WHERE id = ?",
+            (worker, time.time(), task_id))
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    region = Region(**json.loads(region_params), stem=region_stem)
+    return task_id, region, stage
+
+
+def _keep_heartbeat(queue_path: Filepath, task_id: int, worker: str, interval: float,
+                    stop: threading.Event):
+    """Refresh the heartbeat of the task every interval seconds until stop is set, such that
+    long-running stages are not considered abandoned and claimed by other workers."""
+    connection = _connect(queue_path)
+    while not stop.wait(interval):
+        try:
+            connection.execute("UPDATE tasks SET heartbeat = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                               (time.time(), task_id, worker))
+        except sqlite3.OperationalError as error:
+            # A busy database only delays the heartbeat until the next interval:
+            logging.warning("Could not refresh the heartbeat of task %d (%s).", task_id, error)
+    connection.close()
+
+
+def _has_unfinished_tasks(connection: sqlite3.Connection, max_attempts: int,
+                          stale_after: float) -> bool:
+    """Check whether any task is still running or might become runnable later, i. e. is
+    not blocked by a previous stage of its region that has been given up on."""
+    row = connection.execute(_UNFINISHED_QUERY,
+                             (time.time() - stale_after, max_attempts, max_attempts)).fetchone()
+    return row[0] > 0
+
+
+def run_queue_worker(stem: str = "base", worker: Optional[str] = None, max_attempts: int = 3,
+                     stale_after: float = 6 * 3600, poll_interval: float = 30,
+                     dtype_policy: Optional[DtypePolicy] = None):
+    """Pull tasks from the queue of the given stem and run them until no task is left.
+    Any number of these workers can be started in different processes or on different
+    nodes sharing the filesystem.
+
+    Parameters
+    ----------
+    stem : str, optional
+        The stem of the queue, by default "base"
+    worker : Optional[str], optional
+        The name of this worker, by default `{hostname}:{pid}`
+    max_attempts : int, optional
+        How often a task is tried before it's given up on, by default 3
+    stale_after : float, optional
+        The time in s without a heartbeat after which a running task is considered abandoned
+        (e. g. because its worker was killed) and may be claimed again, by default 6 hours.
+        The heartbeat of the running task is refreshed every stale_after / 10.
+    poll_interval : float, optional
+        The time in s to wait if the remaining tasks are still blocked by
+        tasks running on other workers, by default 30
+    dtype_policy : Optional[DtypePolicy], optional
+        The policy to convert the column dtypes of the tables with, by default None
+    """
+    worker = f"{socket.gethostname()}:{os.getpid()}" if worker is None else worker
+    queue_path = get_filepath("job_queue", stem=stem)
+    assert os.path.isfile(queue_path), f"Could not find a queue at {queue_path}, please create it first."
+    connection = _connect(queue_path)
+    while True:
+        task = _claim_next_task(connection, worker, max_attempts, stale_after)
+        if task is None:
+            if not _has_unfinished_tasks(connection, max_attempts, stale_after):
+                break
+            time.sleep(poll_interval)
+            continue
+        task_id, region, stage = task
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=_keep_heartbeat, daemon=True,
+                                     args=(queue_path, task_id, worker, stale_after / 10, stop_heartbeat))
+        heartbeat.start()
+        try:
+            run_stage(region, stage, dtype_policy=dtype_policy)
+        except Exception as error:
+            logging.exception("The %s stage failed for the region with stem '%s'.",
+                              stage, region.stem)
+            connection.execute("UPDATE tasks SET status = 'failed', error = ? WHERE id = ?",
+                               (repr(error), task_id))
+            continue
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+        connection.execute("UPDATE tasks SET status = 'done', error = NULL WHERE id = ?",
+                           (task_id,))
+    connection.close()
+    logging.info("Worker %s found no further tasks in the queue at %s.", worker, queue_path)
+
+
+def get_queue_status(stem: str = "base") -> Table:
+    """Retrieve an overview of all tasks in the queue of the given stem.
+
+    Parameters
+    ----------
+    stem : str, optional
+        The stem of the queue, by default "base"
+
+    Returns
+    -------
+    Table
+        A table with the region stem, stage, status, attempts, worker and error of each task
+    """
+    connection = _connect(get_filepath("job_queue", stem=stem))
+    rows = connection.execute(
+        "SELECT region_stem, stage, status, attempts, worker, error FROM tasks ORDER BY id").fetchall()
+    connection.close()
+    names = ["region_stem", "stage", "status", "attempts", "worker", "error"]
+    if not rows:
+        return Table(names=names, dtype=[str, str, str, int, str, str])
+    return Table(rows=[["" if value is None else value for value in row] for row in rows],
+                 names=names)
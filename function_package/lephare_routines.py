@@ -0,0 +1,234 @@
+"""Functions to call the LePhare routines from within python."""
+import logging
+import subprocess
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from astropy.table import Table, vstack
+
+from .custom_constants import PRESCREEN_ROUTE_CODES
+from .custom_paths import get_filepath, get_lephare_directory
+from .custom_types import Filestem, TableType
+from .file_io import (iter_table_chunks, read_table_from_backup,
+                      write_table_as_backup)
+
+# The zphota arguments used for the different table types, as in `run_lephare.ipynb`.
+# The CONTEXT column of the input is used to skip the missing bands of each source.
+ZPHOTA_ARGS: Dict[TableType, Dict[str, str]] = {
+    "pointlike": {"MAG_REF": "7", "MAG_ABS": "-30,-20"},
+    "extended": {"MAG_REF": "7", "MAG_ABS": "-24,-8"},
+}
+
+
+def get_zphota_args(ttype: TableType, stem: str = "base", template_stem: str = "combined",
+                    star_stem: str = "base", zphotlibs: Optional[Sequence[str]] = None,
+                    extra_args: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Collect the arguments for a zphota run, see run_zphota for the parameters."""
+    if zphotlibs is None:
+        zphotlibs = [f"{template_stem}_{ttype}_maglib", f"{star_stem}_star_maglib"]
+    args = {"ZPHOTLIB": ",".join(zphotlibs),
+            "CAT_IN": get_filepath("lephare_in", ttype, stem),
+            "CAT_OUT": get_filepath("lephare_out", ttype, stem),
+            "PARA_OUT": get_filepath("para_out"),
+            "LIB_ASCII": "YES"}
+    args.update(ZPHOTA_ARGS[ttype])
+    args.update(extra_args if extra_args is not None else {})
+    return args
+
+
+def run_zphota(ttype: TableType, stem: str = "base", template_stem: str = "combined",
+               star_stem: str = "base", zphotlibs: Optional[Sequence[str]] = None,
+               extra_args: Optional[Dict[str, str]] = None):
+    """Run the zphota routine on the LePhare input file of the given stem and ttype,
+    using the same settings as the `run_lephare.ipynb` notebook.
+    The magnitude libraries are expected to be set up already.
+
+    Parameters
+    ----------
+    ttype : TableType
+        Whether to run the pointlike or extended sources
+    stem : str, optional
+        The stem of the input and output files, by default "base"
+    template_stem : str, optional
+        The stem of the galaxy/QSO magnitude library, by default "combined"
+    star_stem : str, optional
+        The stem of the stellar magnitude library, by default "base"
+    zphotlibs : Optional[Sequence[str]], optional
+        The names of the magnitude libraries to fit against, by default the
+        `{template_stem}_{ttype}_maglib` and `{star_stem}_star_maglib` ones.
+    extra_args : Optional[Dict[str, str]], optional
+        Further zphota arguments that override the default ones, by default None
+    """
+    args = get_zphota_args(ttype, stem, template_stem, star_stem, zphotlibs, extra_args)
+    command = [get_lephare_directory("dir") + "source/zphota",
+               "-c", get_filepath("para_in")]
+    for key, value in args.items():
+        command += [f"-{key}", value]
+    logging.info("Running zphota for the %s sources of the '%s' run.", ttype, stem)
+    subprocess.run(command, check=True)
+
+
+def _get_output_colnames(num_cols: Optional[int] = None) -> List[str]:
+    """Read the names of the zphota output columns requested in the para_out file.
+    If the number of columns is given, the entries with one column per band (ending
+    in `()`) are expanded accordingly, e. g. to MAG_OBS_1, MAG_OBS_2, ..."""
+    with open(get_filepath("para_out"), "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f.readlines()]
+    colnames = [line.split()[0] for line in lines if line and not line.startswith("#")]
+    num_per_band = sum(colname.endswith("()") for colname in colnames)
+    if num_cols is None or num_per_band == 0:
+        return colnames
+    num_bands = (num_cols - len(colnames) + num_per_band) // num_per_band
+    expanded = []
+    for colname in colnames:
+        if colname.endswith("()"):
+            expanded += [f"{colname[:-2]}_{i + 1}" for i in range(num_bands)]
+        else:
+            expanded.append(colname)
+    return expanded
+
+
+def read_lephare_output(ttype: TableType, stem: str = "base") -> Table:
+    """Read a zphota output file, naming its columns after the para_out file if possible.
+
+    Parameters
+    ----------
+    ttype : TableType
+        Whether to read the pointlike or extended output
+    stem : str, optional
+        The stem of the output file, by default "base"
+
+    Returns
+    -------
+    Table
+        The output table
+    """
+    table = Table.read(get_filepath("lephare_out", ttype, stem),
+                       format="ascii.no_header", comment="#")
+    colnames = _get_output_colnames(len(table.colnames))
+    if len(colnames) == len(table.colnames):
+        table.rename_columns(table.colnames, colnames)
+    else:
+        logging.warning("The number of output columns does not match the para_out file, "
+                        "so the columns are not renamed.")
+    return table
+
+
+def iter_lephare_output_chunks(ttype: TableType, stem: str = "base",
+                               chunk_size: int = 100000) -> Iterator[Table]:
+    """Iterate over a zphota output file in chunks of rows, naming the columns after
+    the para_out file, see read_lephare_output and iter_table_chunks."""
+    with open(get_filepath("lephare_out", ttype, stem), "r", encoding="utf-8") as f:
+        first_row = next(line for line in f if line.strip() and not line.startswith("#"))
+    colnames = _get_output_colnames(len(first_row.split()))
+    assert len(colnames) == len(first_row.split()), \
+        "The number of output columns does not match the para_out file."
+    yield from iter_table_chunks("lephare_out", ttype, stem, chunk_size, names=colnames)
+
+
+def iter_lephare_output_with_reference(ttype: TableType, stem: str = "base", chunk_size: int = 100000
+                                       ) -> Iterator[Tuple[Table, Table, np.ndarray]]:
+    """Iterate over the processed backup of the given stem in chunks, along with the zphota
+    output rows of the sources in each chunk that went into the full fit (i. e. all of them,
+    unless the table has been pre-screened, see prescreen_sources).
+
+    Yields
+    ------
+    tuple[Table, Table, np.ndarray]
+        The output rows, the chunk of the processed backup, and the mask of the chunk rows
+        the output rows belong to
+    """
+    outputs = iter_lephare_output_chunks(ttype, stem, chunk_size)
+    buffer = None
+    for reference in iter_table_chunks("processed_backup", ttype, stem, chunk_size):
+        is_fitted = np.ones(len(reference), dtype=bool)
+        if "prescreen_route" in reference.colnames:
+            is_fitted = np.asarray(reference["prescreen_route"]) == PRESCREEN_ROUTE_CODES["full"]
+        num_fitted = np.count_nonzero(is_fitted)
+        while buffer is None or len(buffer) < num_fitted:
+            chunk = next(outputs, None)
+            assert chunk is not None, "The zphota output contains fewer sources than the processed backup."
+            buffer = chunk if buffer is None else vstack([buffer, chunk])
+        output, buffer = buffer[:num_fitted], buffer[num_fitted:]
+        assert np.all(np.asarray(output["IDENT"]).astype(str)
+                      == np.asarray(reference["sweep_id"][is_fitted]).astype(str)), \
+            "The zphota output and the processed backup are not in the same order."
+        yield output, reference, is_fitted
+
+
+def write_lephare_output(table: Table, ttype: TableType, stem: str = "base"):
+    """Write a table in the format of the zphota output, such that it can be read
+    with read_lephare_output."""
+    fpath = get_filepath("lephare_out", ttype, stem)
+    table.write(fpath, format="ascii.commented_header", overwrite=True)
+    logging.info("Successfully written a lephare_out file at %s.", fpath)
+
+
+def write_context_batches(ttype: TableType, stem: str = "base",
+                          min_batch_size: int = 1000) -> Dict[Filestem, int]:
+    """Split the LePhare input file of the given stem into batches of sources sharing the
+    same CONTEXT, each written to an input file with the stem `{stem}_context{context}`.
+    Sources with rare contexts are pooled into a `{stem}_context_mixed` batch.
+
+    Parameters
+    ----------
+    ttype : TableType
+        Whether to split the pointlike or extended input
+    stem : str, optional
+        The stem of the input file, by default "base"
+    min_batch_size : int, optional
+        The minimum number of sources for a context to get its own batch, by default 1000
+
+    Returns
+    -------
+    dict[Filestem, int]
+        The context of each batch stem, with -1 for the mixed batch
+    """
+    table = read_table_from_backup("lephare_in", ttype, stem)
+    contexts, counts = np.unique(table["CONTEXT"], return_counts=True)
+    batch_contexts = {f"{stem}_context{context}": context for context, count
+                      in zip(contexts, counts) if count >= min_batch_size}
+    is_mixed = ~np.isin(table["CONTEXT"], list(batch_contexts.values()))
+    if np.any(is_mixed):
+        batch_contexts[f"{stem}_context_mixed"] = -1
+    for batch_stem, context in batch_contexts.items():
+        mask = is_mixed if context == -1 else table["CONTEXT"] == context
+        write_table_as_backup(table[mask], "lephare_in", ttype, batch_stem, overwrite=True)
+    logging.info("Split the %d %s sources into %d context batches.",
+                 len(table), ttype, len(batch_contexts))
+    return batch_contexts
+
+
+def run_zphota_in_context_batches(ttype: TableType, stem: str = "base",
+                                  min_batch_size: int = 1000, **zphota_kwargs):
+    """Run zphota separately for batches of sources sharing the same context (see
+    write_context_batches), forcing that context for each of the batches via GLB_CONTEXT,
+    and merge the results into the output file of the given stem, keeping the input order.
+
+    Parameters
+    ----------
+    ttype : TableType
+        Whether to run the pointlike or extended sources
+    stem : str, optional
+        The stem of the input and output files, by default "base"
+    min_batch_size : int, optional
+        The minimum number of sources for a context to get its own batch, by default 1000
+    **zphota_kwargs
+        Further keyword arguments passed on to run_zphota
+    """
+    batch_contexts = write_context_batches(ttype, stem, min_batch_size)
+    extra_args = zphota_kwargs.pop("extra_args", None) or {}
+    outputs = []
+    for batch_stem, context in batch_contexts.items():
+        batch_args = dict(extra_args)
+        if context != -1:
+            batch_args["GLB_CONTEXT"] = str(context)
+        run_zphota(ttype, stem=batch_stem, extra_args=batch_args, **zphota_kwargs)
+        outputs.append(read_lephare_output(ttype, batch_stem))
+    output = vstack(outputs)
+    # Restore the order of the input file:
+    idents = np.asarray(read_table_from_backup("lephare_in", ttype, stem)["IDENT"]).astype(str)
+    output_idents = np.asarray(output.columns[0]).astype(str)
+    order = np.argsort(output_idents)
+    output = output[order[np.searchsorted(output_idents, idents, sorter=order)]]
+    write_lephare_output(output, ttype, stem)
@@ -7,7 +7,7 @@ from typing import Optional, Sequence
 from astropy.table import Table, vstack
 from astropy.units import UnitsWarning
 
-from .custom_classes import Region
+from .custom_classes import DtypePolicy, Region
 from .custom_constants import ALL_SWEEP_BANDS, ALL_VHS_BANDS
 from .custom_paths import get_directory
 from .custom_types import Dirpath, Filename
@@ -43,7 +43,8 @@ def _sanitise_table(table: Table, region: Optional[Region] = None, name: str = "
 
 def load_and_clean_opt_agn_shu(region: Region, fname: Filename = "optical_agn_shu.fits",
                                dpath: Dirpath = get_directory("catalogues"),
-                               rf_prob_cut: float = 0.94) -> Table:
+                               rf_prob_cut: float = 0.94,
+                               dtype_policy: Optional[DtypePolicy] = None) -> Table:
     """Cleans the opt_agn table by selecting only the relevant columns.
 
     Parameters
@@ -56,6 +57,8 @@ def load_and_clean_opt_agn_shu(region: Region, fname: Filename = "optical_agn_sh
         The directory where the table is saved, by default CATPATH
     rf_prob_cut : float, optional
         The probability cut to apply for the Random Forest Classifier, by default 0.94
+    dtype_policy : Optional[DtypePolicy], optional
+        The policy to convert the column dtypes with, by default None
 
     Returns
     -------
@@ -74,11 +77,14 @@ def load_and_clean_opt_agn_shu(region: Region, fname: Filename = "optical_agn_sh
     table = table[rf_prob_mask]
     logging.info(
         "After the probability cut at p_rf >= %.3f, %d sources are left in the shu_agn table", rf_prob_cut, len(table))
+    if dtype_policy is not None:
+        table = dtype_policy.apply(table)
     return table
 
 
 def load_and_clean_vhs(region: Region, fname: Filename = "vhs_query_efeds.fits",
-                       dpath: Dirpath = get_directory("catalogues"), bands: Sequence[str] = ALL_VHS_BANDS) -> Table:
+                       dpath: Dirpath = get_directory("catalogues"), bands: Sequence[str] = ALL_VHS_BANDS,
+                       dtype_policy: Optional[DtypePolicy] = None) -> Table:
     """Cleans the vhs table by selecting only the relevant columns.
 
     Parameters
@@ -91,6 +97,8 @@ def load_and_clean_vhs(region: Region, fname: Filename = "vhs_query_efeds.fits",
         The directory where the table is saved, by default CATPATH
     bands : Sequence[str], optional
         The bands that the table shall be reduced to
+    dtype_policy : Optional[DtypePolicy], optional
+        The policy to convert the column dtypes with, by default None
 
     Returns
     -------
@@ -114,11 +122,14 @@ def load_and_clean_vhs(region: Region, fname: Filename = "vhs_query_efeds.fits",
         relevant_cols += [band + suffix for band in bands]
     relevant_cols += ["a" + band for band in bands]
     table = table[relevant_cols]
+    if dtype_policy is not None:
+        table = dtype_policy.apply(table)
     return table
 
 
 def load_and_clean_sweep(region: Region, dpath: Dirpath = get_directory("catalogues"),
-                         bands: Sequence[str] = ALL_SWEEP_BANDS) -> Table:
+                         bands: Sequence[str] = ALL_SWEEP_BANDS,
+                         dtype_policy: Optional[DtypePolicy] = None) -> Table:
     """Cleans the sweep table by selecting only the relevant columns.
 
     Parameters
@@ -131,6 +142,8 @@ def load_and_clean_sweep(region: Region, dpath: Dirpath = get_directory("catalog
         The directory where the table is saved, by default CATPATH
     bands : Sequence[str], optional
         The bands that the table shall be reduced to
+    dtype_policy : Optional[DtypePolicy], optional
+        The policy to convert the column dtypes with, by default None
 
     Returns
     -------
@@ -162,6 +175,8 @@ def load_and_clean_sweep(region: Region, dpath: Dirpath = get_directory("catalog
     for prefix in ["flux_", "flux_ivar_", "mw_transmission_"]:
         relevant_cols += [prefix + band for band in bands]
     table = table[relevant_cols]
+    if dtype_policy is not None:
+        table = dtype_policy.apply(table)
     return table
 
 
@@ -1,16 +1,19 @@
 """All functions concerning the matching of different tables."""
 import logging
+from typing import Optional, Tuple, Union
 
 import astropy.units as u
 import numpy as np
-from astropy.coordinates import SkyCoord
-from astropy.table import Table, hstack, join
+from astropy.coordinates import SkyCoord, search_around_sky
+from astropy.table import Table, hstack, join, vstack
 from astroquery.xmatch import XMatch
 
+from .custom_classes import DtypePolicy
 from .load_and_clean_tables import clean_galex_matched_table
 
 
-def match_shu_with_sweep(sweep_table: Table, shu_table: Table, match_radius: float = 0.1) -> Table:
+def match_shu_with_sweep(sweep_table: Table, shu_table: Table, match_radius: float = 0.1,
+                         dtype_policy: Optional[DtypePolicy] = None) -> Table:
     """Perform the match of the given agn table with the sweep table, applying the given
     match radius.
     Returns the subset of the sweep table with matches found in the agn table, and
@@ -24,6 +27,9 @@ def match_shu_with_sweep(sweep_table: Table, shu_table: Table, match_radius: flo
         The table containing ra and dec information of possible agn sources
     match_radius : float, optional
         The maximum radius accepted for a match in arcsec, by default 0.1
+    dtype_policy : Optional[DtypePolicy], optional
+        The policy to convert the column dtypes of the match with, by default None
+
     Returns
     -------
     Table
@@ -49,11 +55,14 @@ def match_shu_with_sweep(sweep_table: Table, shu_table: Table, match_radius: flo
                  len(match), num_of_unmatched_sources, len(shu_table))
     logging.info(
         "From now on, the ra and dec columns refer to the sweep ra and dec.")
+    if dtype_policy is not None:
+        match = dtype_policy.apply(match)
     return match
 
 
 def match_vhs_to_table(table_to_keep: Table, table_to_match_against: Table,
-                       match_table_name="vhs", match_radius: float = 0.5) -> Table:
+                       match_table_name="vhs", match_radius: float = 0.5,
+                       dtype_policy: Optional[DtypePolicy] = None) -> Table:
     """Adds the members of the `table_to_match_against` to the `table_to_keep` and returns
     the left-joined match.
 
@@ -72,6 +81,8 @@ def match_vhs_to_table(table_to_keep: Table, table_to_match_against: Table,
     match_radius : float, optional
         The maximum matching radius in arcsec.
         All sources of `table_to_match_against` with higher distances are ditched, by default 1
+    dtype_policy : Optional[DtypePolicy], optional
+        The policy to convert the column dtypes of the match with, by default None
 
     Returns
     -------
@@ -99,10 +110,13 @@ def match_vhs_to_table(table_to_keep: Table, table_to_match_against: Table,
     match = join(table_to_keep, match, table_names=[
                  "sweep", match_table_name], join_type="left", keys="sweep_id")
     match.rename_columns(["ra_sweep", "dec_sweep"], ["ra", "dec"])
+    if dtype_policy is not None:
+        match = dtype_policy.apply(match)
     return match
 
 
-def match_with_galex_and_clean_it(table_base: Table, match_radius: float = 3.5) -> Table:
+def match_with_galex_and_clean_it(table_base: Table, match_radius: float = 3.5,
+                                  dtype_policy: Optional[DtypePolicy] = None) -> Table:
     """Perform a cds-side cross-match to the GALEX source table on their servers to
     obtain FUV and NUV information.
 
@@ -112,6 +126,8 @@ def match_with_galex_and_clean_it(table_base: Table, match_radius: float = 3.5)
         The table to match the galex sources against.
     match_radius : float, optional
         The maximally allowed distance to sources in the galex table, by default 3.5
+    dtype_policy : Optional[DtypePolicy], optional
+        The policy to convert the column dtypes of the match with, by default None
 
     Returns
     -------
@@ -132,5 +148,135 @@ def match_with_galex_and_clean_it(table_base: Table, match_radius: float = 3.5)
     # Join the matched sources to the base table via the sweep_id column
     match = join(table_base, match, table_names=[
                  "sweep", "galex"], join_type="left", keys="sweep_id_galex")
-
+    if dtype_policy is not None:
+        match = dtype_policy.apply(match)
     return match
+
+
+def _get_positional_errors(table: Table, pos_err: Union[float, str]) -> np.ndarray:
+    """Returns the positional errors in arcsec, either given as a constant or as a column name."""
+    if isinstance(pos_err, str):
+        return np.array(table[pos_err], dtype=float)
+    return np.full(len(table), float(pos_err))
+
+
+def _get_tile_pairs(ra_1: np.ndarray, dec_1: np.ndarray, indices_1: np.ndarray,
+                    ra_2: np.ndarray, dec_2: np.ndarray, order_2: np.ndarray,
+                    search_radius: float, footprint: Tuple[float, float, float, float]) -> Table:
+    """Find all pairs within the search radius for the given sources of table_1, which are
+    expected to lie in one tile, and compute the density of table_2 in the footprint
+    (ra_min, ra_max, dec_min, dec_max) of that tile, independently of the number of
+    table_1 sources in it.
+    The table_2 coordinates are expected to be sorted by dec, with order_2 containing
+    their original indices, so the candidates of the tile can be sliced out directly."""
+    ra_1, dec_1 = ra_1[indices_1], dec_1[indices_1]
+    pad_dec = search_radius / 3600
+    pad_ra = pad_dec / np.cos(np.radians(np.max(np.abs(dec_1)) + pad_dec))
+    start = np.searchsorted(dec_2, dec_1.min() - pad_dec, side="left")
+    stop = np.searchsorted(dec_2, dec_1.max() + pad_dec, side="right")
+    in_ra_range = (ra_2[start:stop] >= ra_1.min() - pad_ra) & (ra_2[start:stop] <= ra_1.max() + pad_ra)
+    candidates = start + np.nonzero(in_ra_range)[0]
+    # The density of table_2 sources per arcsec^2 in the footprint of the tile:
+    ra_min, ra_max, dec_min, dec_max = footprint
+    start = np.searchsorted(dec_2, dec_min, side="left")
+    stop = np.searchsorted(dec_2, dec_max, side="right")
+    num_in_footprint = np.sum((ra_2[start:stop] >= ra_min) & (ra_2[start:stop] <= ra_max))
+    area = np.radians(ra_max - ra_min) * (np.sin(np.radians(dec_max)) - np.sin(np.radians(dec_min))) * \
+        np.degrees(1)**2 * 3600**2
+    density = max(num_in_footprint, 1) / area
+    coords_1 = SkyCoord(ra=ra_1, dec=dec_1, unit="deg")
+    coords_2 = SkyCoord(ra=ra_2[candidates], dec=dec_2[candidates], unit="deg")
+    idx_1, idx_2, separations = search_around_sky(coords_1, coords_2, search_radius * u.arcsec)[:3]
+    return Table([indices_1[idx_1], order_2[candidates[idx_2]], separations.to_value(u.arcsec),
+                  np.full(len(idx_1), density)],
+                 names=["index_1", "index_2", "separation", "density_2"])
+
+
+def match_probabilistically(table_1: Table, table_2: Table, search_radius: float = 3.5,
+                            pos_err_1: Union[float, str] = 0.1, pos_err_2: Union[float, str] = 0.5,
+                            counterpart_prior: float = 0.9, tile_size: float = 1.) -> Table:
+    """Match the two tables probabilistically, considering all candidate pairs within the
+    search radius instead of only the nearest neighbour.
+    For each pair, the positional likelihood is a 2D gaussian in the separation with the
+    combined astrometric errors, divided by the local density of table_2 sources to give a
+    likelihood ratio LR against a chance alignment. The probability of each candidate is
+    LR / (sum of the LRs of all candidates + (1 - prior) / prior), where the prior is the
+    probability of a source in table_1 to have a counterpart at all.
+    The computation is chunked in tiles of table_1 so it scales to large tables.
+
+    Parameters
+    ----------
+    table_1 : Table
+        The table to find counterparts for, expected to contain `ra` and `dec` columns
+        in degrees.
+    table_2 : Table
+        The table to search for counterparts in, expected to contain `ra` and `dec`
+        columns in degrees.
+    search_radius : float, optional
+        The radius in arcsec to consider candidates in, by default 3.5
+    pos_err_1 : Union[float, str], optional
+        The 1-sigma positional error of the table_1 sources in arcsec, either as a constant
+        or as the name of a column containing them, by default 0.1
+    pos_err_2 : Union[float, str], optional
+        The same for the table_2 sources, by default 0.5
+    counterpart_prior : float, optional
+        The prior probability of a table_1 source to have a counterpart in table_2, by default 0.9
+    tile_size : float, optional
+        The size of the tiles in deg, by default 1.
+
+    Returns
+    -------
+    Table
+        A table with a row for each candidate pair, containing the indices of both sources,
+        their separation, the likelihood ratio, the match probability and the probability
+        of the table_1 source not having any counterpart. The is_best column marks the
+        most probable candidate of each table_1 source.
+    """
+    if len(table_1) == 0:
+        logging.info("There are no sources to find counterparts for.")
+        return Table(names=["index_1", "index_2", "separation", "density_2", "likelihood_ratio",
+                            "match_prob", "no_match_prob", "is_best"],
+                     dtype=[int, int, float, float, float, float, float, bool])
+    ra_1, dec_1 = np.array(table_1["ra"]), np.array(table_1["dec"])
+    # Sorting table_2 by dec once lets each tile slice out its candidates via a binary search:
+    order_2 = np.argsort(np.array(table_2["dec"]), kind="stable")
+    ra_2, dec_2 = np.array(table_2["ra"])[order_2], np.array(table_2["dec"])[order_2]
+    ra_tiles = np.floor((ra_1 - ra_1.min()) / tile_size).astype(int)
+    dec_tiles = np.floor((dec_1 - dec_1.min()) / tile_size).astype(int)
+    tile_ids = ra_tiles * (dec_tiles.max() + 1) + dec_tiles
+    order = np.argsort(tile_ids, kind="stable")
+    _, tile_starts = np.unique(tile_ids[order], return_index=True)
+    # The density of table_2 is estimated over the part of each tile covered by table_2,
+    # padded by the search radius so the footprint never collapses:
+    pad = search_radius / 3600
+    extent_2 = (ra_2.min() - pad, ra_2.max() + pad, dec_2.min() - pad, dec_2.max() + pad)
+    tile_pairs = []
+    for indices_1 in np.split(order, tile_starts[1:]):
+        ra_min = ra_1.min() + ra_tiles[indices_1[0]] * tile_size
+        dec_min = dec_1.min() + dec_tiles[indices_1[0]] * tile_size
+        footprint = (max(ra_min, extent_2[0]), min(ra_min + tile_size, extent_2[1]),
+                     max(dec_min, extent_2[2]), min(dec_min + tile_size, extent_2[3]))
+        tile_pairs.append(_get_tile_pairs(ra_1, dec_1, indices_1, ra_2, dec_2, order_2,
+                                          search_radius, footprint))
+    pairs = vstack(tile_pairs)
+    index_1 = np.array(pairs["index_1"], dtype=int)
+    sigma_sq = _get_positional_errors(table_1, pos_err_1)[index_1]**2 + \
+        _get_positional_errors(table_2, pos_err_2)[np.array(pairs["index_2"], dtype=int)]**2
+    likelihood = np.exp(-np.array(pairs["separation"])**2 / (2 * sigma_sq)) / (2 * np.pi * sigma_sq)
+    pairs["likelihood_ratio"] = likelihood / np.array(pairs["density_2"])
+    # Normalise the probabilities for each source of table_1:
+    lr_sums = np.bincount(index_1, weights=pairs["likelihood_ratio"], minlength=len(table_1))
+    no_match_term = (1 - counterpart_prior) / counterpart_prior
+    pairs["match_prob"] = pairs["likelihood_ratio"] / (lr_sums[index_1] + no_match_term)
+    pairs["no_match_prob"] = no_match_term / (lr_sums[index_1] + no_match_term)
+    # The best candidate is the first one after sorting by index_1 and descending probability:
+    best_order = np.lexsort((-np.array(pairs["match_prob"]), index_1))
+    is_first = np.ones(len(pairs), dtype=bool)
+    is_first[1:] = index_1[best_order][1:] != index_1[best_order][:-1]
+    pairs["is_best"] = np.zeros(len(pairs), dtype=bool)
+    pairs["is_best"][best_order[is_first]] = True
+    logging.info("Found %d candidate pairs for %d of the %d sources, %d of which have a best "
+                 "candidate with a match probability above 0.5.", len(pairs),
+                 np.sum(is_first), len(table_1),
+                 np.sum(pairs["is_best"] & (pairs["match_prob"] > 0.5)))
+    return pairs
@@ -0,0 +1,253 @@
+"""Streaming computation of photo-z quality metrics against reference redshifts, using
+accumulators that can be merged between chunks, runs and processes."""
+import logging
+import warnings
+from typing import Optional, Sequence
+
+import numpy as np
+from astropy.table import Table
+
+from .custom_types import Filepath, TableType
+from .lephare_routines import iter_lephare_output_with_reference
+
+# The threshold in |z_phot - z_ref| / (1 + z_ref) above which a source counts as an outlier:
+OUTLIER_THRESHOLD = 0.15
+
+
+class PhotozMetrics:
+    """Accumulates the photo-z deviations dz = (z_phot - z_ref) / (1 + z_ref) binned in
+    redshift, magnitude and source type, such that the NMAD, bias, outlier fraction and
+    failure rate of each bin can be computed without keeping the sources in memory.
+    The NMAD is obtained from a fine histogram of dz, and the errors of all metrics from
+    Poisson bootstrap replicates that are accumulated alongside.
+    """
+
+    def __init__(self, z_bins: Sequence[float] = (0, 0.5, 1, 1.5, 2, 3, 4, 6),
+                 mag_bins: Sequence[float] = (14, 18, 19, 20, 21, 22, 23, 26),
+                 ttypes: Sequence[TableType] = ("pointlike", "extended"),
+                 num_bootstrap: int = 20, dz_range: float = 0.4, dz_step: float = 0.002,
+                 seed: Optional[int] = None):
+        """Initialise empty accumulators for the given binning.
+
+        Parameters
+        ----------
+        z_bins : Sequence[float], optional
+            The edges of the reference redshift bins
+        mag_bins : Sequence[float], optional
+            The edges of the magnitude bins
+        ttypes : Sequence[TableType], optional
+            The source types to distinguish, by default ("pointlike", "extended")
+        num_bootstrap : int, optional
+            The number of bootstrap replicates used for the errors, by default 20
+        dz_range : float, optional
+            The range of the dz histogram used for the NMAD, by default 0.4
+        dz_step : float, optional
+            The width of the dz histogram bins, limiting the precision of the NMAD, by default 0.002
+        seed : Optional[int], optional
+            The seed for the bootstrap weights, by default None
+        """
+        self.z_bins = np.asarray(z_bins, dtype=float)
+        self.mag_bins = np.asarray(mag_bins, dtype=float)
+        self.ttypes = list(ttypes)
+        self.dz_edges = np.arange(-dz_range, dz_range + dz_step / 2, dz_step)
+        self.rng = np.random.default_rng(seed)
+        self.shape = (len(self.ttypes), len(self.z_bins) - 1, len(self.mag_bins) - 1)
+        num_bins = int(np.prod(self.shape))
+        # The first replicate contains the actual data, the others the bootstrap replicates:
+        self.num_replicates = num_bootstrap + 1
+        self.counts = np.zeros((self.num_replicates, num_bins))
+        self.failures = np.zeros((self.num_replicates, num_bins))
+        self.dz_sums = np.zeros((self.num_replicates, num_bins))
+        self.outliers = np.zeros((self.num_replicates, num_bins))
+        # Including an underflow and an overflow bin:
+        self.dz_hists = np.zeros((self.num_replicates, num_bins, len(self.dz_edges) + 1),
+                                 dtype=np.int32)
+
+    def update(self, z_phot: np.ndarray, z_ref: np.ndarray, mag: np.ndarray, ttype: TableType):
+        """Add a chunk of sources of the given type to the accumulators.
+        Sources outside of the redshift and magnitude bins are ignored, and sources with
+        a negative z_phot (e. g. -99 for failed fits) count as failures.
+
+        Parameters
+        ----------
+        z_phot : np.ndarray
+            The photometric redshifts
+        z_ref : np.ndarray
+            The reference (spectroscopic or other photometric) redshifts
+        mag : np.ndarray
+            The magnitudes used for the binning
+        ttype : TableType
+            The type of the sources
+        """
+        z_phot, z_ref, mag = (np.asarray(values, dtype=float) for values in (z_phot, z_ref, mag))
+        z_index = np.searchsorted(self.z_bins, z_ref, side="right") - 1
+        mag_index = np.searchsorted(self.mag_bins, mag, side="right") - 1
+        in_bins = (z_index >= 0) & (z_index < self.shape[1]) & \
+            (mag_index >= 0) & (mag_index < self.shape[2])
+        bin_index = np.ravel_multi_index(
+            (np.full(np.sum(in_bins), self.ttypes.index(ttype)), z_index[in_bins], mag_index[in_bins]),
+            self.shape)
+        z_phot, z_ref = z_phot[in_bins], z_ref[in_bins]
+        num_bins = self.counts.shape[1]
+        weights = np.ones((self.num_replicates, len(bin_index)))
+        weights[1:] = self.rng.poisson(1, size=(self.num_replicates - 1, len(bin_index)))
+        # The flat indices of each (replicate, bin) combination:
+        flat_index = (np.arange(self.num_replicates)[:, None] * num_bins + bin_index).ravel()
+        size = self.num_replicates * num_bins
+        failed = z_phot < 0
+        with np.errstate(invalid="ignore"):
+            dz = np.where(failed, 0, (z_phot - z_ref) / (1 + z_ref))
+        shape = self.counts.shape
+        self.counts += np.bincount(flat_index, weights.ravel(), size).reshape(shape)
+        self.failures += np.bincount(flat_index, (weights * failed).ravel(), size).reshape(shape)
+        valid_weights = weights * ~failed
+        self.dz_sums += np.bincount(flat_index, (valid_weights * dz).ravel(), size).reshape(shape)
+        self.outliers += np.bincount(flat_index, (valid_weights * (np.abs(dz) > OUTLIER_THRESHOLD)).ravel(),
+                                     size).reshape(shape)
+        dz_index = np.searchsorted(self.dz_edges, dz, side="right")
+        num_hist_bins = self.dz_hists.shape[2]
+        hist_index = flat_index * num_hist_bins + np.tile(dz_index, self.num_replicates)
+        self.dz_hists += np.bincount(hist_index, valid_weights.ravel(),
+                                     size * num_hist_bins).reshape(self.dz_hists.shape).astype(np.int32)
+
+    def merge(self, other: "PhotozMetrics") -> "PhotozMetrics":
+        """Add the accumulators of another instance with the same binning to this one."""
+        assert np.array_equal(self.z_bins, other.z_bins) and np.array_equal(self.mag_bins, other.mag_bins) \
+            and self.ttypes == other.ttypes and np.array_equal(self.dz_edges, other.dz_edges) \
+            and self.num_replicates == other.num_replicates, "The binning of the metrics differs."
+        for attr in ["counts", "failures", "dz_sums", "outliers", "dz_hists"]:
+            setattr(self, attr, getattr(self, attr) + getattr(other, attr))
+        return self
+
+    def save(self, fpath: Filepath):
+        """Save the accumulators to disk, e. g. to merge them with those of other processes."""
+        np.savez(fpath, z_bins=self.z_bins, mag_bins=self.mag_bins, ttypes=self.ttypes,
+                 dz_edges=self.dz_edges, counts=self.counts, failures=self.failures,
+                 dz_sums=self.dz_sums, outliers=self.outliers, dz_hists=self.dz_hists)
+
+    @classmethod
+    def load(cls, fpath: Filepath) -> "PhotozMetrics":
+        """Load accumulators saved via save."""
+        with np.load(fpath) as data:
+            dz_step = data["dz_edges"][1] - data["dz_edges"][0]
+            metrics = cls(data["z_bins"], data["mag_bins"], list(data["ttypes"]),
+                          num_bootstrap=len(data["counts"]) - 1,
+                          dz_range=-data["dz_edges"][0], dz_step=dz_step)
+            metrics.dz_edges = data["dz_edges"]
+            for attr in ["counts", "failures", "dz_sums", "outliers", "dz_hists"]:
+                setattr(metrics, attr, data[attr])
+        return metrics
+
+    def _get_cumulative_counts(self, dz: np.ndarray) -> np.ndarray:
+        """Evaluate the cumulative dz distribution of each replicate and bin at the given values
+        (one per replicate and bin), interpolating linearly within the histogram bins.
+        The under- and overflow are treated as point masses at the outermost edges."""
+        hists = self.dz_hists.astype(float)
+        # The counts below each regular bin, including the underflow:
+        below = np.cumsum(hists, axis=2)[..., :-2]
+        step = self.dz_edges[1] - self.dz_edges[0]
+        index = np.clip(np.searchsorted(self.dz_edges, dz, side="right") - 1, 0, len(self.dz_edges) - 2)
+        fraction = np.clip((dz - self.dz_edges[index]) / step, 0, 1)
+        counts = np.take_along_axis(below, index[..., None], axis=2)[..., 0] + \
+            fraction * np.take_along_axis(hists[..., 1:-1], index[..., None], axis=2)[..., 0]
+        counts = np.where(dz < self.dz_edges[0], 0, counts)
+        return np.where(dz >= self.dz_edges[-1], hists.sum(axis=2), counts)
+
+    def _compute_nmad(self) -> np.ndarray:
+        """Compute the NMAD = 1.48 * median(|dz - median(dz)|) of each replicate and bin from
+        the dz histograms, interpolating linearly within the histogram bins.
+        Both the median and the MAD are found by bisection on the cumulative distribution,
+        as the number of sources within +-d of the median increases monotonically with d."""
+        totals = self.dz_hists.astype(float).sum(axis=2)
+        half = totals / 2
+        num_iterations = 50
+        lower = np.full(totals.shape, self.dz_edges[0])
+        upper = np.full(totals.shape, self.dz_edges[-1])
+        for _ in range(num_iterations):
+            middle = (lower + upper) / 2
+            below_half = self._get_cumulative_counts(middle) < half
+            lower, upper = np.where(below_half, middle, lower), np.where(below_half, upper, middle)
+        median = (lower + upper) / 2
+        lower, upper = np.zeros(totals.shape), np.full(totals.shape, self.dz_edges[-1] - self.dz_edges[0])
+        for _ in range(num_iterations):
+            middle = (lower + upper) / 2
+            within = self._get_cumulative_counts(median + middle) - self._get_cumulative_counts(median - middle)
+            below_half = within < half
+            lower, upper = np.where(below_half, middle, lower), np.where(below_half, upper, middle)
+        return np.where(totals > 0, 1.48 * (lower + upper) / 2, np.nan)
+
+    def summarise(self) -> Table:
+        """Compute the metrics for each bin, along with their bootstrap errors.
+
+        Returns
+        -------
+        Table
+            A table with the source type, the redshift and magnitude bin edges, the number of
+            sources, and the failure rate, bias, NMAD and outlier fraction with their errors
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            num_valid = self.counts - self.failures
+            metrics = {"failure_rate": self.failures / self.counts,
+                       "bias": self.dz_sums / num_valid,
+                       "nmad": self._compute_nmad(),
+                       "outlier_fraction": self.outliers / num_valid}
+        ttype_index, z_index, mag_index = np.unravel_index(
+            np.arange(self.counts.shape[1]), self.shape)
+        table = Table()
+        table["ttype"] = np.array(self.ttypes)[ttype_index]
+        table["z_min"], table["z_max"] = self.z_bins[z_index], self.z_bins[z_index + 1]
+        table["mag_min"], table["mag_max"] = self.mag_bins[mag_index], self.mag_bins[mag_index + 1]
+        table["num_sources"] = self.counts[0].astype(int)
+        for name, values in metrics.items():
+            table[name] = values[0]
+            # Empty bins have no valid replicates:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                table[f"{name}_err"] = np.nanstd(values[1:], axis=0) if len(values) > 1 else np.nan
+        return table
+
+
+def accumulate_photoz_metrics(stem: str = "base", ttypes: Sequence[TableType] = ("pointlike", "extended"),
+                              z_ref_col: str = "shu_z_phot", mag_band: str = "r",
+                              z_phot_col: str = "Z_BEST", chunk_size: int = 100000,
+                              metrics: Optional[PhotozMetrics] = None) -> PhotozMetrics:
+    """Stream over the zphota output and the processed backup of the given stem in chunks
+    and accumulate the photo-z metrics against the reference redshifts.
+    Both files are expected to be in the same order, which is the case if the LePhare
+    input was written from the processed backup. Pre-screened sources that did not go
+    into the full fit are skipped.
+
+    Parameters
+    ----------
+    stem : str, optional
+        The stem of the run, by default "base"
+    ttypes : Sequence[TableType], optional
+        The source types to include, by default ("pointlike", "extended")
+    z_ref_col : str, optional
+        The column of the processed backup containing the reference redshift, by default "shu_z_phot"
+    mag_band : str, optional
+        The band whose corrected flux is converted to the AB magnitude used for binning, by default "r"
+    z_phot_col : str, optional
+        The column of the zphota output containing the photometric redshift, by default "Z_BEST"
+    chunk_size : int, optional
+        The number of sources per chunk, by default 100000
+    metrics : Optional[PhotozMetrics], optional
+        The accumulators to add to, by default new ones with the default binning
+
+    Returns
+    -------
+    PhotozMetrics
+        The accumulated metrics
+    """
+    metrics = PhotozMetrics() if metrics is None else metrics
+    for ttype in ttypes:
+        num_sources = 0
+        for output, reference, is_fitted in iter_lephare_output_with_reference(ttype, stem, chunk_size):
+            reference = reference[is_fitted]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                mag = -2.5 * np.log10(np.asarray(reference[f"c_flux_{mag_band}"], dtype=float)) - 48.6
+            metrics.update(output[z_phot_col], reference[z_ref_col], mag, ttype)
+            num_sources += len(output)
+        logging.info("Accumulated the photo-z metrics of %d %s sources of the '%s' run.",
+                     num_sources, ttype, stem)
+    return metrics
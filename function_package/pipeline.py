@@ -0,0 +1,246 @@
+"""Functions chaining the routines of the notebooks into stages that can be run for a
+single region, using the backups on disk to pass the tables from one stage to the next."""
+import logging
+import os
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+from astropy.table import Table, vstack
+
+from .custom_classes import DtypePolicy, Region
+from .custom_constants import PRESCREEN_ROUTE_CODES
+from .custom_paths import get_filepath
+from .custom_types import TableExtended, TablePointlike, TableSplit, TableType
+from .file_io import read_table_from_backup, write_table_as_backup
+from .lephare_routines import run_zphota
+from .load_and_clean_tables import (load_and_clean_opt_agn_shu,
+                                    load_and_clean_sweep, load_and_clean_vhs)
+from .matching import (match_shu_with_sweep, match_vhs_to_table,
+                       match_with_galex_and_clean_it)
+from .pre_processing import (prescreen_sources, process_for_lephare,
+                             process_galex_columns, process_sweep_columns,
+                             process_vhs_columns, split_table_by_sourcetype)
+
+# The match radii in arcsec found to be reasonable in my master thesis:
+MATCH_RADII = {"shu": 0.1, "vhs": 0.19, "galex": 2.1}
+
+# The cuts used by the prescreen stage, see prescreen_sources:
+PRESCREEN_KWARGS = {"min_valid_bands": 3, "snr_band": "r", "snr_min": None,
+                    "max_locus_distance": 0.1}
+
+
+def load_region_tables(region: Region, dtype_policy: Optional[DtypePolicy] = None,
+                       margin: float = 0) -> Tuple[Table, Table, Table]:
+    """Load and clean the shu, vhs and sweep tables for the region.
+
+    Parameters
+    ----------
+    region : Region
+        The region to constrain the tables to
+    dtype_policy : Optional[DtypePolicy], optional
+        The policy to convert the column dtypes with, by default None
+    margin : float, optional
+        A margin in deg by which the region is enlarged for the shu and vhs tables so
+        that sweep sources close to the boundaries can still find their counterparts, by default 0
+
+    Returns
+    -------
+    tuple[Table, Table, Table]
+        The shu, vhs and sweep tables
+    """
+    padded = region.get_padded(margin) if margin > 0 else region
+    shu_table = load_and_clean_opt_agn_shu(padded, dtype_policy=dtype_policy)
+    vhs_table = load_and_clean_vhs(padded, dtype_policy=dtype_policy)
+    sweep_table = load_and_clean_sweep(region, dtype_policy=dtype_policy)
+    return shu_table, vhs_table, sweep_table
+
+
+def match_region_tables(shu_table: Table, vhs_table: Table, sweep_table: Table,
+                        dtype_policy: Optional[DtypePolicy] = None) -> Table:
+    """Match the loaded tables using the MATCH_RADII, as in `match_tables.ipynb`."""
+    match = match_shu_with_sweep(sweep_table, shu_table, MATCH_RADII["shu"],
+                                 dtype_policy=dtype_policy)
+    match = match_vhs_to_table(match, vhs_table, match_radius=MATCH_RADII["vhs"],
+                               dtype_policy=dtype_policy)
+    return match_with_galex_and_clean_it(match, MATCH_RADII["galex"],
+                                         dtype_policy=dtype_policy)
+
+
+def process_match_table(table: Table) -> Tuple[TablePointlike, TableExtended]:
+    """Process the matched table and split it into the pointlike and extended tables."""
+    table = process_galex_columns(table)
+    table = process_sweep_columns(table)
+    pointlike, extended = split_table_by_sourcetype(table)
+    return process_vhs_columns(pointlike), process_vhs_columns(extended)
+
+
+def run_load_stage(region: Region, dtype_policy: Optional[DtypePolicy] = None):
+    """Load and clean the shu, vhs and sweep tables for the region and back them up."""
+    tables = load_region_tables(region, dtype_policy)
+    for path_type, table in zip(["shu_backup", "vhs_backup", "sweep_backup"], tables):
+        write_table_as_backup(table, path_type, stem=region.stem, overwrite=True)
+
+
+def run_match_stage(region: Region, dtype_policy: Optional[DtypePolicy] = None):
+    """Match the loaded tables of the region and write the match backup."""
+    shu_table = read_table_from_backup("shu_backup", stem=region.stem)
+    vhs_table = read_table_from_backup("vhs_backup", stem=region.stem)
+    sweep_table = read_table_from_backup("sweep_backup", stem=region.stem)
+    match = match_region_tables(shu_table, vhs_table, sweep_table, dtype_policy)
+    write_table_as_backup(match, "match_backup", stem=region.stem, overwrite=True)
+
+
+def run_process_stage(region: Region, dtype_policy: Optional[DtypePolicy] = None):
+    """Process the match backup of the region and write the pointlike and extended backups."""
+    table = read_table_from_backup("match_backup", stem=region.stem)
+    if dtype_policy is not None:
+        # Reading the backup masks the NaN sentinels again.
+        table = dtype_policy.apply(table)
+    for ttype, subset in zip(["pointlike", "extended"], process_match_table(table)):
+        write_table_as_backup(subset, "processed_backup", ttype,
+                              stem=region.stem, overwrite=True)
+
+
+def run_prescreen_stage(region: Region, dtype_policy: Optional[DtypePolicy] = None):
+    """Assign the pre-screening routes (see prescreen_sources) to the processed tables of
+    the region, storing them in the `prescreen_route` column of the processed backups."""
+    for ttype in ["pointlike", "extended"]:
+        table = read_table_from_backup("processed_backup", ttype, stem=region.stem)
+        table["prescreen_route"] = prescreen_sources(table, ttype, **PRESCREEN_KWARGS)
+        write_table_as_backup(table, "processed_backup", ttype,
+                              stem=region.stem, overwrite=True)
+
+
+def _write_lephare_inputs(table: TableSplit, ttype: TableType, stem: str):
+    """Write the LePhare input file of the given stem for the processed table. If the table
+    has been pre-screened, only the sources routed to the full fit are written to it, and
+    the ones routed to the star-only fit to the input file of the `{stem}_stars` stem."""
+    if "prescreen_route" not in table.colnames:
+        write_table_as_backup(process_for_lephare(table), "lephare_in", ttype,
+                              stem=stem, overwrite=True)
+        return
+    routes = np.asarray(table["prescreen_route"])
+    write_table_as_backup(process_for_lephare(table[routes == PRESCREEN_ROUTE_CODES["full"]]),
+                          "lephare_in", ttype, stem=stem, overwrite=True)
+    is_star = routes == PRESCREEN_ROUTE_CODES["star_only"]
+    star_fpath = get_filepath("lephare_in", ttype, f"{stem}_stars")
+    if np.any(is_star):
+        write_table_as_backup(process_for_lephare(table[is_star]), "lephare_in", ttype,
+                              stem=f"{stem}_stars", overwrite=True)
+    elif os.path.isfile(star_fpath):
+        # Remove the input of a previous run, which would otherwise be fitted again:
+        os.remove(star_fpath)
+
+
+def run_lephare_input_stage(region: Region, dtype_policy: Optional[DtypePolicy] = None):
+    """Write the LePhare input files for the processed tables of the region."""
+    for ttype in ["pointlike", "extended"]:
+        table = read_table_from_backup("processed_backup", ttype, stem=region.stem)
+        _write_lephare_inputs(table, ttype, region.stem)
+
+
+def run_zphota_stage(region: Region, dtype_policy: Optional[DtypePolicy] = None):
+    """Run zphota on both LePhare input files of the region, and only with the star library
+    on the ones of the sources routed to the star-only fit by the prescreen stage."""
+    for ttype in ["pointlike", "extended"]:
+        run_zphota(ttype, stem=region.stem)
+        if os.path.isfile(get_filepath("lephare_in", ttype, f"{region.stem}_stars")):
+            run_zphota(ttype, stem=f"{region.stem}_stars", zphotlibs=["base_star_maglib"])
+
+
+# The stages in the order they need to be run in:
+PIPELINE_STAGES: Dict[str, Callable[..., None]] = {
+    "load": run_load_stage,
+    "match": run_match_stage,
+    "process": run_process_stage,
+    "prescreen": run_prescreen_stage,
+    "lephare_in": run_lephare_input_stage,
+    "zphota": run_zphota_stage,
+}
+
+
+def run_stage(region: Region, stage: str, dtype_policy: Optional[DtypePolicy] = None):
+    """Run the given stage of the pipeline for the region.
+
+    Parameters
+    ----------
+    region : Region
+        The region to run the stage for. Its stem is used for all of the backups.
+    stage : str
+        One of the stages in PIPELINE_STAGES
+    dtype_policy : Optional[DtypePolicy], optional
+        The policy to convert the column dtypes with after loading the tables, by default None
+    """
+    assert stage in PIPELINE_STAGES, f"The stage ({stage}) you have specified does not exist, please use one of the following: {', '.join(PIPELINE_STAGES)}"
+    logging.info("Running the %s stage for the region with stem '%s'.", stage, region.stem)
+    PIPELINE_STAGES[stage](region, dtype_policy=dtype_policy)
+
+
+def _merge_with_backup(table: Table, path_type: str, stem: str, ttype: Optional[str] = None,
+                       dtype_policy: Optional[DtypePolicy] = None) -> Tuple[Table, Table]:
+    """Append the table to the existing backup, keeping only the first occurrence of each
+    sweep_id, and write the result.
+    Returns the merged table and the rows of the given table that were actually added."""
+    existing = read_table_from_backup(path_type, ttype, stem)
+    if dtype_policy is not None:
+        # Both tables need consistent dtypes to be stacked
+        existing = dtype_policy.apply(existing)
+        table = dtype_policy.apply(table)
+    merged = vstack([existing, table])
+    _, first_indices = np.unique(np.asarray(merged["sweep_id"]).astype(str), return_index=True)
+    first_indices = np.sort(first_indices)
+    added = merged[first_indices[first_indices >= len(existing)]]
+    merged = merged[first_indices]
+    logging.info("Merged %d new sources into the %s, which now contains %d sources.",
+                 len(added), path_type, len(merged))
+    write_table_as_backup(merged, path_type, ttype, stem=stem, overwrite=True)
+    return merged, added
+
+
+def extend_region_incrementally(region: Region, dtype_policy: Optional[DtypePolicy] = None,
+                                backup_stem: str = "base"):
+    """Extend the backups saved on disk under the given backup_stem to the given (larger)
+    region, only loading, matching and processing the sky area that has been added.
+    The results are merged into the existing match, processed and LePhare input files,
+    removing duplicate sources (e. g. on the boundaries) via their sweep_id.
+
+    Parameters
+    ----------
+    region : Region
+        The new region, which needs to contain the one saved on disk under its stem
+        (e. g. the default stem "" used in `match_tables.ipynb`).
+    dtype_policy : Optional[DtypePolicy], optional
+        The policy to convert the column dtypes with, by default None
+    backup_stem : str, optional
+        The stem of the match, processed and LePhare input files to extend, by default "base"
+    """
+    old_region = Region(load_from_disk=True, stem=region.stem)
+    assert region.contains(old_region), "The new region needs to contain the one saved on disk."
+    # Make sure that the backups exist before the expensive loading and matching:
+    for path_type, ttype in [("match_backup", None), ("processed_backup", "pointlike"),
+                             ("processed_backup", "extended")]:
+        fpath = get_filepath(path_type, ttype, backup_stem)
+        assert os.path.isfile(fpath), f"Could not find the {path_type} at {fpath}, please check the backup_stem."
+    deltas = region.subtract(old_region)
+    if len(deltas) == 0:
+        logging.info("The region has not changed, so there is nothing to do.")
+        return
+    # The counterparts of sweep sources close to the boundaries may lie outside of them:
+    margin = 2 * max(MATCH_RADII["shu"], MATCH_RADII["vhs"]) / 3600
+    matches = []
+    for delta in deltas:
+        logging.info("Processing the added area:\n%s", delta)
+        tables = load_region_tables(delta, dtype_policy, margin=margin)
+        matches.append(match_region_tables(*tables, dtype_policy=dtype_policy))
+    _, added = _merge_with_backup(vstack(matches), "match_backup", backup_stem,
+                                  dtype_policy=dtype_policy)
+    for ttype, subset in zip(["pointlike", "extended"], process_match_table(added)):
+        processed, _ = _merge_with_backup(subset, "processed_backup", backup_stem, ttype,
+                                          dtype_policy)
+        if "prescreen_route" in processed.colnames:
+            # The added sources have not been pre-screened yet:
+            processed["prescreen_route"] = prescreen_sources(processed, ttype, **PRESCREEN_KWARGS)
+            write_table_as_backup(processed, "processed_backup", ttype,
+                                  stem=backup_stem, overwrite=True)
+        _write_lephare_inputs(processed, ttype, backup_stem)
+    region.save_to_disk()
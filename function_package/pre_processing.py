@@ -1,12 +1,15 @@
 """Functions to perform the processing needed in preparation for LePhare."""
 import logging
-from typing import Sequence, Tuple
+from typing import Dict, Optional, Sequence, Tuple
 
 import numpy as np
 from astropy.table import Table
 
+from .custom_classes import DtypePolicy
 from .custom_constants import (ALL_BANDS, ALL_GALEX_BANDS, ALL_SWEEP_BANDS,
-                               ALL_VHS_BANDS, VEGA_AB_DICT)
+                               ALL_VHS_BANDS, DTYPE_POLICY_RTOL, LEPHARE_BANDS,
+                               PRESCREEN_ROUTE_CODES, STELLAR_LOCUS,
+                               SWEEP_TYPE_CODES, VEGA_AB_DICT)
 from .custom_types import (Band, TableExtended, TablePointlike, TableSplit,
                            TableType)
 
@@ -83,15 +86,13 @@ def process_galex_columns(table: Table, bands: Sequence[Band] = ALL_GALEX_BANDS)
 def _delete_all_apermag_cols(table: TableSplit, ttype: TableType) -> Table:
     """Delete all column names containing `apermag{suffix}` from the given table.
     Suffix should be "4" or "6".
+    The columns are removed and renamed in place, so no data is copied.
     """
-    num_cols_before = len(table.colnames)
     rm_suffix = "4" if ttype == "extended" else "6"
-    cols_to_keep = [
-        col for col in table.colnames if not f"apermag{rm_suffix}" in col]
-    table = table[cols_to_keep]
-    num_cols_lost = num_cols_before - len(cols_to_keep)
+    cols_to_remove = [col for col in table.colnames if f"apermag{rm_suffix}" in col]
+    table.remove_columns(cols_to_remove)
     logging.debug("Found and removed %d apermag%s columns.",
-                  num_cols_lost, rm_suffix)
+                  len(cols_to_remove), rm_suffix)
     rename_suffix = "6" if ttype == "extended" else "4"
     oldnames = [
         col for col in table.colnames if f"apermag{rename_suffix}" in col]
@@ -104,12 +105,15 @@ def _delete_all_apermag_cols(table: TableSplit, ttype: TableType) -> Table:
 def split_table_by_sourcetype(table: Table) -> Tuple[TablePointlike, TableExtended]:
     """Splits the given table into two subsets of point-like and extended sources and
     deletes irrelevant (vhs) columns, as 2''8 (apermag4) photometry is used for pointlike
-    and apermag6 is used for extended sources
+    and apermag6 is used for extended sources.
+    To avoid copies of the whole table, it is sorted in place such that the pointlike
+    sources come first (keeping the order within both subsets), and the two subsets are
+    slices sharing the column buffers of the input table.
 
     Parameters
     ----------
     table : Table
-        The input table containing the matches
+        The input table containing the matches, which is reordered in place
 
     Returns
     -------
@@ -120,11 +124,17 @@ def split_table_by_sourcetype(table: Table) -> Tuple[TablePointlike, TableExtend
     TableExtended : Table
         The extended table
     """
-    mask = table["sweep_type"] == "PSF"
-    pointlike = table[mask]
-    pointlike = _delete_all_apermag_cols(pointlike, "pointlike")
-    extended = table[~mask]
-    extended = _delete_all_apermag_cols(extended, "extended")
+    # The sweep_type might have been encoded to integers by a DtypePolicy:
+    psf_type = SWEEP_TYPE_CODES["PSF"] if table["sweep_type"].dtype.kind in "iu" else "PSF"
+    is_extended = np.asarray(table["sweep_type"] != psf_type)
+    num_pointlike = len(table) - np.count_nonzero(is_extended)
+    if np.any(is_extended[:num_pointlike]):
+        # Sorting moves the rows column by column, so only one column is copied at a time.
+        table["_is_extended"] = is_extended
+        table.sort("_is_extended", kind="stable")
+        table.remove_column("_is_extended")
+    pointlike = _delete_all_apermag_cols(table[:num_pointlike], "pointlike")
+    extended = _delete_all_apermag_cols(table[num_pointlike:], "extended")
     return pointlike, extended
 
 
@@ -165,27 +175,169 @@ def process_vhs_columns(table: TableSplit, bands: Sequence[str] = ALL_VHS_BANDS)
     return table
 
 
-def process_for_lephare(table: TableSplit, bands: Sequence[Band] = ALL_BANDS) -> TableSplit:
-    """Returns a table only containing SWEEP ra and dec and then, in
-    alternating fashion, flux and flux error for each of the requested bands
-    (in the order given by BAND_LIST), followed by the ZSPEC column.
+def _get_valid_band_mask(table: TableSplit, band: Band, snr_min: Optional[float] = None) -> np.ndarray:
+    """Returns a mask of the sources with a usable corrected flux and error in the given band."""
+    flux = table[f"c_flux_{band}"]
+    flux_err = table[f"c_flux_err_{band}"]
+    valid = np.ones(len(table), dtype=bool)
+    for col in [flux, flux_err]:
+        if hasattr(col, "mask"):
+            valid &= ~np.ma.getmaskarray(col)
+    flux = np.ma.getdata(flux)
+    flux_err = np.ma.getdata(flux_err)
+    with np.errstate(invalid="ignore"):
+        valid &= np.isfinite(flux) & np.isfinite(flux_err) & (flux_err > 0) & (flux != -99.)
+        if snr_min is not None:
+            valid &= flux / flux_err >= snr_min
+    return valid
+
+
+def compute_lephare_context(table: TableSplit, bands: Sequence[Band] = LEPHARE_BANDS,
+                            snr_min: Optional[float] = None, reject_maskbits: int = 0,
+                            maskbit_bands: Sequence[Band] = ALL_SWEEP_BANDS) -> np.ndarray:
+    """Compute the LePhare context of each source, i. e. the sum of 2**i for each band i
+    (in the order of the bands, which has to be the order of the columns in the LePhare input)
+    with valid photometry. For the default LEPHARE_BANDS, which follow the FILTER_LIST order
+    in `base_in.para`, this corresponds to FUV=1, NUV=2, ..., W4=8192.
+
+    Parameters
+    ----------
+    table : TableSplit
+        The processed table containing the `c_flux_{band}` and `c_flux_err_{band}` columns
+    bands : Sequence[Band], optional
+        The bands in the order of the LePhare input columns, by default LEPHARE_BANDS
+    snr_min : Optional[float], optional
+        If provided, bands with a lower signal-to-noise ratio are considered invalid, by default None
+    reject_maskbits : int, optional
+        The sweep_maskbits for which the maskbit_bands are considered invalid, by default 0
+    maskbit_bands : Sequence[Band], optional
+        The bands affected by the reject_maskbits, by default ALL_SWEEP_BANDS
+
+    Returns
+    -------
+    np.ndarray
+        The integer context of each source
+    """
+    context = np.zeros(len(table), dtype=np.int64)
+    if reject_maskbits:
+        flagged = (np.ma.getdata(table["sweep_maskbits"]) & reject_maskbits) != 0
+    for i, band in enumerate(bands):
+        if f"c_flux_{band}" not in table.colnames:
+            continue
+        valid = _get_valid_band_mask(table, band, snr_min)
+        if reject_maskbits and band in maskbit_bands:
+            valid &= ~flagged
+        context[valid] += 2**i
+    return context
+
+
+def compute_stellar_locus_distance(table: TableSplit, num_points: int = 200) -> np.ndarray:
+    """Compute the distance (in mag) of each source to the STELLAR_LOCUS in the space of
+    its colours, with NaN for the sources without valid photometry in all of the bands
+    involved. The locus is interpolated linearly between its sampling points."""
+    colours = list(STELLAR_LOCUS)
+    bands = list(dict.fromkeys(band for colour in colours for band in colour))
+    mags, valid = {}, np.ones(len(table), dtype=bool)
+    for band in bands:
+        band_valid = _get_valid_band_mask(table, band) & (np.ma.getdata(table[f"c_flux_{band}"]) > 0)
+        valid &= band_valid
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mags[band] = -2.5 * np.log10(np.ma.getdata(table[f"c_flux_{band}"]).astype(float)) - 48.6
+    source_colours = np.column_stack([mags[first] - mags[second] for first, second in colours])
+    samples = np.linspace(0, 1, len(STELLAR_LOCUS[colours[0]]))
+    locus = np.column_stack([np.interp(np.linspace(0, 1, num_points), samples, STELLAR_LOCUS[colour])
+                             for colour in colours])
+    distance = np.full(len(table), np.inf)
+    # Looping over the locus points keeps the memory footprint at the size of the table:
+    for point in locus:
+        np.minimum(distance, np.sqrt(np.sum((source_colours - point)**2, axis=1)), out=distance)
+    distance[~valid] = np.nan
+    return distance
+
+
+def prescreen_sources(table: TableSplit, ttype: TableType, bands: Sequence[Band] = ALL_BANDS,
+                      min_valid_bands: int = 3, snr_band: Band = "r", snr_min: Optional[float] = None,
+                      max_locus_distance: float = 0.1) -> np.ndarray:
+    """Decide for each source whether it is fitted with the full set of libraries, only with
+    the star library or not at all, using vectorised cuts on the processed table.
+    Sources with less than min_valid_bands bands with valid photometry, or below the S/N
+    floor in the snr_band, are rejected. Pointlike sources lying within max_locus_distance
+    of the STELLAR_LOCUS (which requires valid g, r, z, W1 and W2 photometry) are only fitted
+    with the star library. All other sources are passed on to the full fit unchanged.
+
+    Parameters
+    ----------
+    table : TableSplit
+        The processed table containing the `c_flux_{band}` and `c_flux_err_{band}` columns
+    ttype : TableType
+        Whether the table contains the pointlike or extended sources
+    bands : Sequence[Band], optional
+        The bands considered for the number of valid bands, by default ALL_BANDS
+    min_valid_bands : int, optional
+        The minimum number of bands with valid photometry, by default 3
+    snr_band : Band, optional
+        The band the S/N floor is applied in, by default "r"
+    snr_min : Optional[float], optional
+        The S/N floor, by default None, meaning that no floor is applied
+    max_locus_distance : float, optional
+        The maximum distance (in mag) to the stellar locus for star-only fitting, by default 0.1
+
+    Returns
+    -------
+    np.ndarray
+        The PRESCREEN_ROUTE_CODES of the sources
+    """
+    num_valid = sum(_get_valid_band_mask(table, band).astype(int)
+                    for band in bands if f"c_flux_{band}" in table.colnames)
+    rejected = num_valid < min_valid_bands
+    if snr_min is not None:
+        rejected |= ~_get_valid_band_mask(table, snr_band, snr_min)
+    routes = np.full(len(table), PRESCREEN_ROUTE_CODES["full"], dtype=np.int8)
+    if ttype == "pointlike":
+        with np.errstate(invalid="ignore"):
+            is_star = compute_stellar_locus_distance(table) <= max_locus_distance
+        routes[is_star] = PRESCREEN_ROUTE_CODES["star_only"]
+    routes[rejected] = PRESCREEN_ROUTE_CODES["reject"]
+    counts = {route: np.count_nonzero(routes == code) for route, code in PRESCREEN_ROUTE_CODES.items()}
+    logging.info("Pre-screened the %d %s sources: %d for the full fit, %d for the star-only fit "
+                 "and %d rejected.", len(table), ttype, counts["full"], counts["star_only"],
+                 counts["reject"])
+    return routes
+
+
+def process_for_lephare(table: TableSplit, bands: Sequence[Band] = LEPHARE_BANDS,
+                        snr_min: Optional[float] = None, reject_maskbits: int = 0) -> TableSplit:
+    """Returns a table only containing the SWEEP ID and then, in alternating
+    fashion, flux and flux error for each of the requested bands (in the order given
+    by LEPHARE_BANDS, i. e. the FILTER_LIST of `base_in.para`), followed by the CONTEXT
+    and ZSPEC columns. Bands without photometry in the table (like the i band) are
+    filled with -99.
+    The context of each source only contains the bands with valid photometry,
+    see compute_lephare_context for the optional quality cuts.
     """
     col_list = ["sweep_id"]
     new_colnames = ["IDENT"]
     if "zspec" not in table.colnames:
         table["zspec"] = -99.
+    missing_bands = [band for band in bands if f"c_flux_{band}" not in table.colnames]
     for band in bands:
-        col_list.append("c_flux_" + band)
-        col_list.append("c_flux_err_" + band)
-        new_colnames.append(band)
-        new_colnames.append(band + "_err")
+        if band not in missing_bands:
+            col_list.append("c_flux_" + band)
+            col_list.append("c_flux_err_" + band)
+            new_colnames.append(band)
+            new_colnames.append(band + "_err")
     for infocol in ["CONTEXT", "zspec", "String"]:
         col_list.append(infocol)
         new_colnames.append(infocol)
-    table["CONTEXT"] = "-1"
+    table["CONTEXT"] = compute_lephare_context(table, bands, snr_min, reject_maskbits)
     table["String"] = ""
     table = table[col_list]
     table.rename_columns(col_list, new_colnames)
+    for band in missing_bands:
+        # The columns need to be at the position of the band in the filter list:
+        index = 1 + 2 * list(bands).index(band)
+        table.add_column(-99., name=band + "_err", index=index)
+        table.add_column(-99., name=band, index=index)
     for col in new_colnames:
         if col not in ["IDENT", "CONTEXT", "STRING"]:
             # We need to try/except since astropy doesn't like filling columns that
@@ -194,6 +346,55 @@ def process_for_lephare(table: TableSplit, bands: Sequence[Band] = ALL_BANDS) ->
                 table[col] = table[col].filled(-99.)
             except AttributeError:
                 pass
-    # Replace any null values with -99. as they otherwise cause problems for LePhare:
-    # for colname in new_colnames:
+            # Replace any null values with -99. as they otherwise cause problems for LePhare.
+            # These are e. g. the NaN sentinels used in place of masks by the DtypePolicy.
+            if table[col].dtype.kind == "f":
+                table[col][~np.isfinite(table[col])] = -99.
     return table
+
+
+def check_dtype_policy_precision(table: Table, dtype_policy: DtypePolicy,
+                                 rtol: float = DTYPE_POLICY_RTOL) -> Dict[str, float]:
+    """Run the processing of a matched table both in float64 and with the given policy and
+    make sure the resulting LePhare inputs agree within the given relative tolerance.
+
+    Parameters
+    ----------
+    table : Table
+        A matched table (or a representative subset of it), which is not modified
+    dtype_policy : DtypePolicy
+        The policy to check
+    rtol : float, optional
+        The maximum relative deviation allowed, by default DTYPE_POLICY_RTOL
+
+    Returns
+    -------
+    dict[str, float]
+        The maximum relative deviation for each of the flux columns of both table types
+    """
+    results = []
+    for policy in [None, dtype_policy]:
+        processed = table.copy()
+        if policy is not None:
+            processed = policy.apply(processed)
+        processed = process_galex_columns(processed)
+        processed = process_sweep_columns(processed)
+        results.append([process_for_lephare(process_vhs_columns(subset))
+                        for subset in split_table_by_sourcetype(processed)])
+    deviations = {}
+    for ttype, reference, lean in zip(["pointlike", "extended"], *results):
+        assert np.all(reference["IDENT"] == lean["IDENT"].astype(reference["IDENT"].dtype)), \
+            "The order of the sources differs between the two processing paths."
+        for col in reference.colnames[1:-3]:
+            ref_values = np.asarray(reference[col], dtype=np.float64)
+            lean_values = np.asarray(lean[col], dtype=np.float64)
+            assert np.all((ref_values == -99.) == (lean_values == -99.)), \
+                f"The missing values of {col} in the {ttype} table differ."
+            valid = ref_values != -99.
+            with np.errstate(divide="ignore", invalid="ignore"):
+                rel_dev = np.abs((lean_values[valid] - ref_values[valid]) / ref_values[valid])
+            deviations[f"{ttype}_{col}"] = np.nanmax(rel_dev, initial=0.)
+    max_dev = max(deviations.values())
+    logging.info("The maximum relative deviation of the dtype policy is %.2e.", max_dev)
+    assert max_dev <= rtol, f"The dtype policy leads to relative deviations of up to {max_dev:.2e} (> {rtol:.0e})."
+    return deviations
@@ -0,0 +1,121 @@
+"""Functions to calibrate the match radii for the cross-matches from a single query of all
+pairs within the maximum radius, instead of rerunning the matches for each radius."""
+import logging
+from typing import Sequence
+
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import SkyCoord, search_around_sky
+from astropy.table import Table
+from astroquery.xmatch import XMatch
+
+
+def _get_coords(table: Table, offset: float = 0) -> SkyCoord:
+    """Returns the coordinates of the table, shifted by the offset (in arcsec) in dec."""
+    return SkyCoord(ra=np.array(table["ra"]), dec=np.array(table["dec"]) + offset / 3600,
+                    unit="deg")
+
+
+def _get_nearest_separations(indices: np.ndarray, separations: np.ndarray,
+                             num_sources: int) -> np.ndarray:
+    """Reduce a list of pairs to the separation (in arcsec) of the nearest counterpart of each
+    source, with inf for the sources without any counterpart."""
+    nearest = np.full(num_sources, np.inf)
+    np.minimum.at(nearest, indices, separations)
+    return nearest
+
+
+def _summarise_calibration(nearest: np.ndarray, nearest_random: np.ndarray,
+                           radii: Sequence[float]) -> Table:
+    """Compute the match statistics for each radius from the nearest separations of the real
+    and the randomly offset sources."""
+    radii = np.asarray(radii, dtype=float)
+    num_matched = np.searchsorted(np.sort(nearest), radii, side="right")
+    num_spurious = np.searchsorted(np.sort(nearest_random), radii, side="right")
+    num_genuine = np.clip(num_matched - num_spurious, 0, None)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        completeness = num_genuine / np.max(num_genuine)
+        contamination = num_spurious / num_matched
+    table = Table([radii, num_matched, num_spurious, completeness, contamination],
+                  names=["radius", "num_matched", "num_spurious", "completeness", "contamination"])
+    table["radius"].info.unit = "arcsec"
+    return table
+
+
+def calibrate_match_radius(table_to_match: Table, table_to_search: Table,
+                           radii: Sequence[float], offset: float = 60) -> Table:
+    """Compute the match statistics for a whole grid of match radii from one query of all
+    pairs within the largest radius, e. g. for the shu table (table_to_match) against the
+    sweep table (table_to_search) as in match_shu_with_sweep.
+    The number of spurious matches is estimated by repeating the query with the sources of
+    table_to_match shifted by the offset.
+
+    Parameters
+    ----------
+    table_to_match : Table
+        The table of sources to find counterparts for, expected to contain `ra` and `dec`
+        columns in degrees.
+    table_to_search : Table
+        The table to search for counterparts in, expected to contain `ra` and `dec` columns
+        in degrees.
+    radii : Sequence[float]
+        The grid of match radii in arcsec
+    offset : float, optional
+        The offset in arcsec used for the random matches, which needs to be large compared
+        to the radii, by default 60
+
+    Returns
+    -------
+    Table
+        For each radius, the number of sources with a counterpart, the estimated number of
+        spurious matches, the completeness (the number of genuine matches relative to the
+        maximum over all radii) and the contamination (the fraction of spurious matches).
+    """
+    max_radius = np.max(radii) * u.arcsec
+    coords_to_search = _get_coords(table_to_search)
+    nearest = []
+    for shift in [0, offset]:
+        indices, _, separations, _ = search_around_sky(
+            _get_coords(table_to_match, shift), coords_to_search, max_radius)
+        nearest.append(_get_nearest_separations(
+            indices, separations.to_value(u.arcsec), len(table_to_match)))
+    calibration = _summarise_calibration(*nearest, radii)
+    logging.info("Calibrated %d match radii for %d sources.", len(radii), len(table_to_match))
+    return calibration
+
+
+def calibrate_galex_match_radius(table_base: Table, radii: Sequence[float],
+                                 offset: float = 60) -> Table:
+    """Compute the match statistics for a grid of match radii to the GALEX table, using a
+    single cds-side cross-match at the largest radius (and another one with the sources
+    shifted by the offset for the spurious matches), see calibrate_match_radius.
+
+    Parameters
+    ----------
+    table_base : Table
+        The table to match the galex sources against, expected to contain `ra` and `dec`
+        columns in degrees.
+    radii : Sequence[float]
+        The grid of match radii in arcsec
+    offset : float, optional
+        The offset in arcsec used for the random matches, by default 60
+
+    Returns
+    -------
+    Table
+        The match statistics for each radius, see calibrate_match_radius.
+    """
+    galex_table_id = "II/335/galex_ais"
+    ref_table = Table([np.array(table_base["ra"]), np.array(table_base["dec"]),
+                       np.arange(len(table_base))], names=["ra", "dec", "row_index"])
+    nearest = []
+    for shift in [0, offset]:
+        shifted = ref_table.copy()
+        shifted["dec"] += shift / 3600
+        match = XMatch.query(cat1=shifted, cat2=f"vizier:{galex_table_id}",
+                             max_distance=np.max(radii) * u.arcsec, colRA1="ra", colDec1="dec")
+        nearest.append(_get_nearest_separations(
+            np.array(match["row_index"]), np.array(match["angDist"]), len(table_base)))
+    calibration = _summarise_calibration(*nearest, radii)
+    logging.info("Calibrated %d galex match radii for %d sources.", len(radii), len(table_base))
+    return calibration
@@ -0,0 +1,372 @@
+"""Pre-aggregated sky density maps and colour histograms of the processed tables and the
+LePhare output, such that they can be plotted quickly regardless of the number of sources."""
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import astropy.units as u
+import numpy as np
+from astropy.table import Table
+
+from .custom_paths import get_filepath
+from .custom_types import Band, Filepath, Filestem, TableType
+from .file_io import iter_table_chunks
+from .lephare_routines import iter_lephare_output_with_reference
+
+try:
+    from astropy_healpix import HEALPix
+except ImportError:
+    HEALPix = None
+
+# A colour is given by the two bands it is the difference of, e. g. ("g", "r") for g - r:
+Colour = Tuple[Band, Band]
+
+# The quantities on the x and y axes of the default histograms, either a colour or the
+# name of a column of the zphota output:
+HISTOGRAM_AXES: Dict[str, Tuple[Colour, Union[Colour, str]]] = {
+    "gr_rz": (("g", "r"), ("r", "z")),
+    "rz_zw1": (("r", "z"), ("z", "w1")),
+    "gr_w1w2": (("g", "r"), ("w1", "w2")),
+    "gr_zbest": (("g", "r"), "Z_BEST"),
+    "w1w2_zbest": (("w1", "w2"), "Z_BEST"),
+}
+
+COLOUR_EDGES = np.linspace(-2, 4, 241)
+REDSHIFT_EDGES = np.linspace(0, 6, 241)
+
+
+class Histogram2D:
+    """A 2D histogram with fixed bin edges that can be filled chunk by chunk and merged with
+    others. As the counts are kept in both dimensions, the median (or any other percentile)
+    of y in each x bin can be read off it as well."""
+
+    def __init__(self, x_edges: np.ndarray, y_edges: np.ndarray,
+                 counts: Optional[np.ndarray] = None):
+        self.x_edges = np.asarray(x_edges, dtype=float)
+        self.y_edges = np.asarray(y_edges, dtype=float)
+        shape = (len(self.x_edges) - 1, len(self.y_edges) - 1)
+        self.counts = np.zeros(shape, dtype=np.int64) if counts is None else counts
+
+    def update(self, x: np.ndarray, y: np.ndarray):
+        """Add the (finite) pairs of values inside of the edges to the histogram."""
+        counts, _, _ = np.histogram2d(x, y, bins=[self.x_edges, self.y_edges])
+        self.counts += counts.astype(np.int64)
+
+    def merge(self, other: "Histogram2D") -> "Histogram2D":
+        """Add the counts of another histogram with the same edges to this one."""
+        assert np.array_equal(self.x_edges, other.x_edges) and np.array_equal(self.y_edges, other.y_edges), \
+            "The edges of the histograms differ."
+        self.counts += other.counts
+        return self
+
+    def get_percentiles(self, q: float = 50, min_count: int = 10) -> np.ndarray:
+        """Compute the q-th percentile of y in each x bin, interpolating linearly within
+        the y bins, with NaN for bins with less than min_count sources."""
+        totals = self.counts.sum(axis=1)
+        cumulative = np.cumsum(self.counts, axis=1)
+        percentiles = np.full(len(totals), np.nan)
+        for i in np.flatnonzero(totals >= min_count):
+            target = q / 100 * totals[i]
+            # The first populated bin in which the cumulative count reaches the target:
+            k = np.flatnonzero((cumulative[i] >= target) & (self.counts[i] > 0))[0]
+            fraction = (target - (cumulative[i, k] - self.counts[i, k])) / self.counts[i, k]
+            percentiles[i] = self.y_edges[k] + fraction * (self.y_edges[k + 1] - self.y_edges[k])
+        return percentiles
+
+    def to_dict(self, prefix: str) -> Dict[str, np.ndarray]:
+        """Return the arrays to save, with their names prefixed."""
+        return {f"{prefix}_x_edges": self.x_edges, f"{prefix}_y_edges": self.y_edges,
+                f"{prefix}_counts": self.counts}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, np.ndarray], prefix: str) -> "Histogram2D":
+        """Restore a histogram from the arrays returned by to_dict."""
+        return cls(data[f"{prefix}_x_edges"], data[f"{prefix}_y_edges"], data[f"{prefix}_counts"])
+
+
+class SkyDensityMap:
+    """The number of sources per HEALPix pixel (in nested ordering), which can be filled
+    chunk by chunk and merged with others. Requires the astropy_healpix package."""
+
+    def __init__(self, nside: int = 128, counts: Optional[np.ndarray] = None):
+        assert HEALPix is not None, "Please install astropy_healpix to compute sky density maps."
+        self.nside = int(nside)
+        self.healpix = HEALPix(nside=self.nside, order="nested")
+        self.counts = np.zeros(self.healpix.npix, dtype=np.int64) if counts is None else counts
+
+    def update(self, ra: np.ndarray, dec: np.ndarray):
+        """Add the sources at the given coordinates (in degrees) to the map."""
+        is_valid = np.isfinite(ra) & np.isfinite(dec)
+        pixels = self.healpix.lonlat_to_healpix(np.asarray(ra)[is_valid] * u.deg,
+                                                np.asarray(dec)[is_valid] * u.deg)
+        self.counts += np.bincount(pixels, minlength=self.healpix.npix)
+
+    def merge(self, other: "SkyDensityMap") -> "SkyDensityMap":
+        """Add the counts of another map with the same nside to this one."""
+        assert self.nside == other.nside, "The nside of the maps differs."
+        self.counts += other.counts
+        return self
+
+    def get_density(self) -> np.ndarray:
+        """Return the number of sources per square degree in each pixel."""
+        return self.counts / self.healpix.pixel_area.to_value(u.deg**2)
+
+    def to_dict(self, prefix: str) -> Dict[str, np.ndarray]:
+        """Return the arrays to save, with their names prefixed."""
+        return {f"{prefix}_nside": np.array(self.nside), f"{prefix}_counts": self.counts}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, np.ndarray], prefix: str) -> "SkyDensityMap":
+        """Restore a map from the arrays returned by to_dict."""
+        return cls(int(data[f"{prefix}_nside"]), data[f"{prefix}_counts"])
+
+
+SummaryMaps = Dict[str, Union[Histogram2D, SkyDensityMap]]
+
+
+def _get_colour(table: Table, colour: Colour) -> np.ndarray:
+    """Compute the AB colour of the given bands from the corrected fluxes, with NaN for
+    sources without a valid flux in either of them."""
+    mags = []
+    for band in colour:
+        flux = np.asarray(table[f"c_flux_{band}"], dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mags.append(np.where(flux > 0, -2.5 * np.log10(flux) - 48.6, np.nan))
+    return mags[0] - mags[1]
+
+
+def _create_empty_maps(axes: Dict[str, Tuple[Colour, Union[Colour, str]]],
+                       nside: Optional[int]) -> SummaryMaps:
+    """Create the empty histograms for the given axes, and the sky map if an nside is given."""
+    maps = {name: Histogram2D(COLOUR_EDGES, COLOUR_EDGES if isinstance(y, tuple) else REDSHIFT_EDGES)
+            for name, (_, y) in axes.items()}
+    if nside is not None:
+        maps["sky"] = SkyDensityMap(nside)
+    return maps
+
+
+def _aggregate_file(stem: Filestem, ttype: TableType, chunk_size: int,
+                    axes: Dict[str, Tuple[Colour, Union[Colour, str]]],
+                    nside: Optional[int]) -> SummaryMaps:
+    """Aggregate the processed backup (and the zphota output, if there is one and any of the
+    axes needs it) of the given stem and ttype into summary maps."""
+    needs_output = any(isinstance(y, str) for _, y in axes.values())
+    has_output = os.path.isfile(get_filepath("lephare_out", ttype, stem))
+    if needs_output and not has_output:
+        logging.warning("There is no zphota output for the %s sources of the '%s' run, so the "
+                        "redshift histograms are left empty.", ttype, stem)
+    use_output = needs_output and has_output
+    maps = _create_empty_maps(axes, nside)
+    if use_output:
+        chunks = iter_lephare_output_with_reference(ttype, stem, chunk_size)
+    else:
+        chunks = ((None, table, None) for table in iter_table_chunks("processed_backup", ttype,
+                                                                      stem, chunk_size))
+    for output, table, is_fitted in chunks:
+        if "sky" in maps:
+            maps["sky"].update(np.asarray(table["ra"], dtype=float), np.asarray(table["dec"], dtype=float))
+        for name, (x, y) in axes.items():
+            if not isinstance(y, str):
+                maps[name].update(_get_colour(table, x), _get_colour(table, y))
+            elif use_output:
+                # Only the fully fitted sources have a zphota output:
+                maps[name].update(_get_colour(table[is_fitted], x), np.asarray(output[y], dtype=float))
+    return maps
+
+
+def _save_maps(maps: SummaryMaps, fpath: Filepath,
+               axes: Dict[str, Tuple[Colour, Union[Colour, str]]]):
+    """Save the summary maps to a single npz file, along with the axes they were built for."""
+    arrays = {"names": np.array(list(maps)), "axes": np.array(json.dumps(axes, sort_keys=True))}
+    for name, summary_map in maps.items():
+        arrays.update(summary_map.to_dict(name))
+    np.savez(fpath, **arrays)
+
+
+def load_summary_maps(fpath: Filepath) -> SummaryMaps:
+    """Load the summary maps saved by build_summary_maps.
+
+    Parameters
+    ----------
+    fpath : Filepath
+        The path of the npz file
+
+    Returns
+    -------
+    SummaryMaps
+        The histograms and (if computed) the sky map under the key "sky"
+    """
+    with np.load(fpath) as data:
+        return {str(name): (SkyDensityMap if name == "sky" else Histogram2D).from_dict(data, name)
+                for name in data["names"]}
+
+
+def _is_cache_valid(stem: Filestem, ttype: TableType) -> bool:
+    """Check whether the cached maps are newer than the files they are built from."""
+    cache_path = get_filepath("summary_maps", ttype, stem)
+    if not os.path.isfile(cache_path):
+        return False
+    sources = [get_filepath(path_type, ttype, stem) for path_type in ["processed_backup", "lephare_out"]]
+    return all(os.path.getmtime(cache_path) >= os.path.getmtime(fpath)
+               for fpath in sources if os.path.isfile(fpath))
+
+
+def _matches_definition(maps: SummaryMaps, fpath: Filepath,
+                        axes: Dict[str, Tuple[Colour, Union[Colour, str]]],
+                        nside: Optional[int]) -> bool:
+    """Check whether the cached maps were built for the given axes, bin edges and nside."""
+    with np.load(fpath) as data:
+        if "axes" not in data or str(data["axes"]) != json.dumps(axes, sort_keys=True):
+            return False
+    expected = _create_empty_maps(axes, nside)
+    if set(maps) != set(expected):
+        return False
+    for name, summary_map in expected.items():
+        if name == "sky":
+            if maps[name].nside != summary_map.nside:
+                return False
+        elif not (np.array_equal(maps[name].x_edges, summary_map.x_edges)
+                  and np.array_equal(maps[name].y_edges, summary_map.y_edges)):
+            return False
+    return True
+
+
+def _get_file_maps(stem: Filestem, ttype: TableType, chunk_size: int,
+                   axes: Dict[str, Tuple[Colour, Union[Colour, str]]],
+                   nside: Optional[int]) -> SummaryMaps:
+    """Load the maps of the given stem and ttype from the cache if they are up to date and
+    were built with the same definitions, or build and cache them."""
+    fpath = get_filepath("summary_maps", ttype, stem)
+    if _is_cache_valid(stem, ttype):
+        maps = load_summary_maps(fpath)
+        if _matches_definition(maps, fpath, axes, nside):
+            return maps
+    maps = _aggregate_file(stem, ttype, chunk_size, axes, nside)
+    _save_maps(maps, fpath, axes)
+    logging.info("Cached the summary maps of the %s sources of the '%s' run.", ttype, stem)
+    return maps
+
+
+def build_summary_maps(stems: Sequence[Filestem] = ("base",),
+                       ttypes: Sequence[TableType] = ("pointlike", "extended"),
+                       axes: Optional[Dict[str, Tuple[Colour, Union[Colour, str]]]] = None,
+                       nside: Optional[int] = 128, chunk_size: int = 100000,
+                       num_workers: int = 1) -> SummaryMaps:
+    """Aggregate the processed backups (and zphota outputs) of the given stems and table
+    types into a HEALPix sky density map and 2D histograms, streaming over the files in chunks.
+    The maps of each file are cached next to the processed backup and only rebuilt once
+    the file has changed, and different files are aggregated in parallel.
+
+    Parameters
+    ----------
+    stems : Sequence[Filestem], optional
+        The stems of the runs to aggregate, e. g. the tiles of a campaign, by default ("base",)
+    ttypes : Sequence[TableType], optional
+        The source types to aggregate, by default ("pointlike", "extended")
+    axes : Optional[Dict[str, Tuple[Colour, Union[Colour, str]]]], optional
+        The x and y quantities of each histogram, by default HISTOGRAM_AXES
+    nside : Optional[int], optional
+        The HEALPix nside of the sky map, or None to skip it, by default 128
+    chunk_size : int, optional
+        The number of sources per chunk, by default 100000
+    num_workers : int, optional
+        The number of processes aggregating the files, by default 1
+
+    Returns
+    -------
+    SummaryMaps
+        The merged histograms and (if requested) the sky map under the key "sky"
+    """
+    axes = HISTOGRAM_AXES if axes is None else axes
+    if nside is not None and HEALPix is None:
+        logging.warning("astropy_healpix is not installed, so the sky map is skipped.")
+        nside = None
+    jobs = [(stem, ttype, chunk_size, axes, nside) for stem in stems for ttype in ttypes]
+    if num_workers > 1:
+        with ProcessPoolExecutor(num_workers) as executor:
+            results = list(executor.map(_get_file_maps, *zip(*jobs)))
+    else:
+        results = [_get_file_maps(*job) for job in jobs]
+    maps = results[0]
+    for other in results[1:]:
+        for name, summary_map in maps.items():
+            summary_map.merge(other[name])
+    logging.info("Built the summary maps for %d files.", len(jobs))
+    return maps
+
+
+def plot_sky_density(sky_map: SkyDensityMap, ax=None, resolution: float = 0.1,
+                     ra_range: Optional[Tuple[float, float]] = None,
+                     dec_range: Optional[Tuple[float, float]] = None):
+    """Plot the source density of the sky map on a regular ra/dec grid.
+
+    Parameters
+    ----------
+    sky_map : SkyDensityMap
+        The map to plot
+    ax : matplotlib.axes.Axes, optional
+        The axis to plot on, by default the current one
+    resolution : float, optional
+        The grid spacing in degrees, by default 0.1
+    ra_range, dec_range : Optional[Tuple[float, float]], optional
+        The ranges to plot, by default those of the non-empty pixels
+
+    Returns
+    -------
+    matplotlib.image.AxesImage
+        The plotted image
+    """
+    import matplotlib.pyplot as plt
+    ax = plt.gca() if ax is None else ax
+    if ra_range is None or dec_range is None:
+        ra, dec = sky_map.healpix.healpix_to_lonlat(np.flatnonzero(sky_map.counts))
+        ra_range = (np.min(ra.deg), np.max(ra.deg)) if ra_range is None else ra_range
+        dec_range = (np.min(dec.deg), np.max(dec.deg)) if dec_range is None else dec_range
+    ra_grid, dec_grid = np.meshgrid(np.arange(*ra_range, resolution), np.arange(*dec_range, resolution))
+    pixels = sky_map.healpix.lonlat_to_healpix(ra_grid * u.deg, dec_grid * u.deg)
+    image = ax.imshow(sky_map.get_density()[pixels], origin="lower", aspect="auto",
+                      extent=[ra_range[0], ra_range[1], dec_range[0], dec_range[1]])
+    ax.set_xlim(ra_range[1], ra_range[0])  # RA increases to the left
+    ax.set_xlabel("RA [deg]")
+    ax.set_ylabel("Dec [deg]")
+    plt.colorbar(image, ax=ax, label=r"Sources per deg$^2$")
+    return image
+
+
+def plot_histogram_2d(histogram: Histogram2D, ax=None, show_median: bool = True,
+                      xlabel: str = "", ylabel: str = "", log: bool = True):
+    """Plot a 2D histogram, optionally along with the median of y in each x bin.
+
+    Parameters
+    ----------
+    histogram : Histogram2D
+        The histogram to plot
+    ax : matplotlib.axes.Axes, optional
+        The axis to plot on, by default the current one
+    show_median : bool, optional
+        Whether to overplot the median of y in each x bin, by default True
+    xlabel, ylabel : str, optional
+        The axis labels
+    log : bool, optional
+        Whether to use a logarithmic colour scale, by default True
+
+    Returns
+    -------
+    matplotlib.collections.QuadMesh
+        The plotted histogram
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
+    ax = plt.gca() if ax is None else ax
+    counts = np.ma.masked_equal(histogram.counts.T, 0)
+    mesh = ax.pcolormesh(histogram.x_edges, histogram.y_edges, counts,
+                         norm=LogNorm() if log else None)
+    if show_median:
+        x_centres = (histogram.x_edges[1:] + histogram.x_edges[:-1]) / 2
+        ax.plot(x_centres, histogram.get_percentiles(50), color="k", label="Median")
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    plt.colorbar(mesh, ax=ax, label="Sources")
+    return mesh
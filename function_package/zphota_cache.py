@@ -0,0 +1,173 @@
+"""A cache for the zphota results of single sources, such that only new or changed
+sources need to be refitted after upstream changes."""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from astropy.table import Table
+
+from .custom_paths import get_filepath, get_lephare_directory
+from .custom_types import Filepath, TableType
+from .file_io import read_table_from_backup, write_table_as_backup
+from .lephare_routines import (get_zphota_args, read_lephare_output,
+                               run_zphota, write_lephare_output)
+
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (hash TEXT PRIMARY KEY, result TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+# The number of hashes to look up per query, as sqlite limits the number of variables:
+_QUERY_BATCH_SIZE = 500
+
+
+def _hash_file(fpath: Filepath, hasher: hashlib.blake2b):
+    """Feed the contents of the given file (if it exists) into the hasher."""
+    hasher.update(fpath.encode())
+    if not os.path.isfile(fpath):
+        return
+    with open(fpath, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            hasher.update(block)
+
+
+def get_zphota_fingerprint(ttype: TableType, zphotlibs: Optional[Sequence[str]] = None,
+                           extra_args: Optional[Dict[str, str]] = None, **zphota_kwargs) -> str:
+    """Compute a fingerprint of everything apart from the input photometry that determines
+    the zphota results, i. e. the parameter files, the magnitude libraries and the arguments.
+
+    Parameters
+    ----------
+    ttype : TableType
+        Whether the run is for the pointlike or extended sources
+    zphotlibs : Optional[Sequence[str]], optional
+        The names of the magnitude libraries, see run_zphota
+    extra_args : Optional[Dict[str, str]], optional
+        Further zphota arguments, see run_zphota
+    **zphota_kwargs
+        The template_stem and star_stem, see run_zphota
+
+    Returns
+    -------
+    str
+        The hexadecimal fingerprint
+    """
+    args = get_zphota_args(ttype, zphotlibs=zphotlibs, extra_args=extra_args, **zphota_kwargs)
+    # The file names don't influence the results of each source:
+    for key in ["CAT_IN", "CAT_OUT"]:
+        args.pop(key)
+    hasher = hashlib.blake2b(json.dumps(args, sort_keys=True).encode(), digest_size=16)
+    _hash_file(get_filepath("para_in"), hasher)
+    _hash_file(get_filepath("para_out"), hasher)
+    lib_dir = get_lephare_directory("work") + "lib_mag/"
+    for lib in args["ZPHOTLIB"].split(","):
+        for suffix in [".bin", ".doc"]:
+            _hash_file(lib_dir + lib + suffix, hasher)
+    return hasher.hexdigest()
+
+
+def hash_lephare_input_rows(table: Table, fingerprint: str) -> np.ndarray:
+    """Hash each row of a LePhare input table, i. e. its fluxes, errors, context and zspec,
+    together with the given fingerprint. The IDENT is not part of the hash.
+
+    Parameters
+    ----------
+    table : Table
+        The LePhare input table
+    fingerprint : str
+        The fingerprint of the zphota settings, see get_zphota_fingerprint
+
+    Returns
+    -------
+    np.ndarray
+        The hexadecimal hash of each row
+    """
+    cols = [col for col in table.colnames if col not in ["IDENT", "String"]]
+    values = np.ascontiguousarray(
+        np.column_stack([np.asarray(table[col], dtype=np.float64) for col in cols]))
+    rows = values.view(np.dtype((np.void, values.dtype.itemsize * values.shape[1]))).ravel()
+    prefix = fingerprint.encode()
+    return np.array([hashlib.blake2b(prefix + row.tobytes(), digest_size=16).hexdigest()
+                     for row in rows])
+
+
+def _connect(ttype: TableType, cache_stem: str) -> sqlite3.Connection:
+    """Connect to the cache of the given stem, creating it if necessary."""
+    connection = sqlite3.connect(get_filepath("zphota_cache", ttype, cache_stem), timeout=60)
+    connection.executescript(_CACHE_SCHEMA)
+    return connection
+
+
+def _lookup_results(connection: sqlite3.Connection, hashes: Sequence[str]) -> Dict[str, List]:
+    """Retrieve the cached results for the given hashes."""
+    results = {}
+    for i in range(0, len(hashes), _QUERY_BATCH_SIZE):
+        batch = list(hashes[i:i + _QUERY_BATCH_SIZE])
+        query = f"SELECT hash, result FROM results WHERE hash IN ({','.join('?' * len(batch))})"
+        for key, result in connection.execute(query, batch):
+            results[key] = json.loads(result)
+    return results
+
+
+def _get_cached_colnames(connection: sqlite3.Connection) -> Optional[List[str]]:
+    """Retrieve the output colnames stored in the cache, if there are any results yet."""
+    row = connection.execute("SELECT value FROM meta WHERE key = 'colnames'").fetchone()
+    return None if row is None else json.loads(row[0])
+
+
+def run_zphota_cached(ttype: TableType, stem: str = "base", cache_stem: str = "base",
+                      **zphota_kwargs):
+    """Run zphota on the input file of the given stem, only fitting the sources whose
+    input rows (or zphota settings) are not in the cache yet, and assemble the full
+    output file from the cached and fresh results.
+
+    Parameters
+    ----------
+    ttype : TableType
+        Whether to run the pointlike or extended sources
+    stem : str, optional
+        The stem of the input and output files, by default "base"
+    cache_stem : str, optional
+        The stem of the cache, which may be shared between runs, by default "base"
+    **zphota_kwargs
+        Further keyword arguments passed on to run_zphota
+    """
+    table = read_table_from_backup("lephare_in", ttype, stem)
+    assert len(table) > 0, "The input file does not contain any sources."
+    fingerprint = get_zphota_fingerprint(ttype, **zphota_kwargs)
+    hashes = hash_lephare_input_rows(table, fingerprint)
+    unique_hashes, first_indices = np.unique(hashes, return_index=True)
+    connection = _connect(ttype, cache_stem)
+    results = _lookup_results(connection, unique_hashes)
+    is_uncached = ~np.isin(unique_hashes, list(results))
+    logging.info("Found %d of the %d distinct %s sources in the cache, fitting the remaining %d.",
+                 len(results), len(unique_hashes), ttype, np.sum(is_uncached))
+    colnames = _get_cached_colnames(connection)
+    if np.any(is_uncached):
+        uncached_stem = f"{stem}_uncached"
+        write_table_as_backup(table[np.sort(first_indices[is_uncached])], "lephare_in", ttype,
+                              uncached_stem, overwrite=True)
+        run_zphota(ttype, stem=uncached_stem, **zphota_kwargs)
+        fresh = read_lephare_output(ttype, uncached_stem)
+        assert colnames is None or colnames == fresh.colnames, \
+            "The output columns differ from the cached ones, please use a new cache_stem."
+        colnames = fresh.colnames
+        fresh_hashes = hashes[np.sort(first_indices[is_uncached])]
+        # The IDENT is not cached as it is replaced by the one of the requesting source:
+        fresh_columns = [np.asarray(fresh[col]).tolist() for col in colnames[1:]]
+        fresh_results = dict(zip(fresh_hashes, map(list, zip(*fresh_columns))))
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('colnames', ?)",
+                               (json.dumps(colnames),))
+            connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?)",
+                                   [(key, json.dumps(result)) for key, result in fresh_results.items()])
+        results.update(fresh_results)
+    connection.close()
+    rows = [results[key] for key in hashes]
+    output = Table(rows=rows, names=colnames[1:])
+    output.add_column(table["IDENT"], index=0, name=colnames[0])
+    write_lephare_output(output, ttype, stem)